@@ -19,10 +19,12 @@
 
 import types
 import re
+import time
 import inspect
 import importlib
-import copy
 import logging
+from collections import OrderedDict
+from decimal import Decimal
 
 from gettext import gettext as _
 
@@ -34,11 +36,24 @@ except ImportError:
 
 from mathlib import MathLib
 from plotlib import Plot
+from symbolic import Differentiator, tree_to_str
+from solver import Solver, SOLVEHELP, MINIMIZEHELP, INTEGRATEHELP
 
 PLOTHELP = _(
     "plot(eqn, var=-a..b), plot the equation 'eqn' with the variable 'var' in the \
 range from a to b")
 
+DIFFHELP = _(
+    "diff(eqn, var), the derivative of the equation 'eqn' with respect to the \
+variable 'var'. If 'var' has a value, the derivative at that value is \
+returned, otherwise the derivative as an equation.")
+
+
+def _restore_error(cls, state):
+    e = Exception.__new__(cls)
+    e.__dict__.update(state)
+    return e
+
 
 class ParserError(Exception):
 
@@ -49,6 +64,14 @@ class ParserError(Exception):
         self.eqn = eqn
         self.set_range(start, end)
 
+    def __reduce__(self):
+        # Errors are sent back from worker processes. The subclasses take
+        # different constructor arguments, so restore the attributes only.
+        state = dict(self.__dict__)
+        if not isinstance(state.get('eqn'), str):
+            state['eqn'] = ''
+        return (_restore_error, (type(self), state))
+
     def get_range(self):
         return self._range
 
@@ -114,6 +137,20 @@ class RuntimeError(ParserError):
         return msg
 
 
+class LimitError(RuntimeError):
+
+    """
+    Class for reporting that an evaluation exceeded its budget. Functions
+    raise it with <start> None, the call of the function sets the range.
+    """
+
+    def __init__(self, msg, start, eqn, end=None):
+        self.positioned = start is not None
+        if start is None:
+            start = 0
+        RuntimeError.__init__(self, msg, start, eqn, end)
+
+
 class ArgumentError(ParserError):
 
     """Class for error if incorrect arguments are entered."""
@@ -179,20 +216,83 @@ class Helper:
                  "use help(index) for the index") % (topic)
 
 
+class EvalBudget:
+
+    '''
+    Limits for one evaluation, shared by all nested evaluations.
+
+    max_time: wall-clock time limit in seconds, or None.
+    max_steps: maximum number of operations to evaluate, or None.
+    '''
+
+    # Only look at the clock every this many steps
+    CLOCK_INTERVAL = 64
+
+    def __init__(self, max_time=None, max_steps=None):
+        self.steps = 0
+        self.max_steps = max_steps
+        if max_time is not None:
+            self.deadline = time.monotonic() + max_time
+        else:
+            self.deadline = None
+        self._next_check = self.CLOCK_INTERVAL
+        if max_steps is not None:
+            self._next_check = min(self._next_check, max_steps + 1)
+
+    def step(self, ofs):
+        '''Count one step, raise a RuntimeError at <ofs> if over budget.'''
+        self.steps += 1
+        if self.steps >= self._next_check:
+            self._check(ofs)
+
+    def _check(self, ofs):
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise LimitError(_('Calculation needs too many steps'), ofs, "")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise LimitError(_('Calculation takes too long'), ofs, "")
+
+        self._next_check = self.steps + self.CLOCK_INTERVAL
+        if self.max_steps is not None:
+            self._next_check = min(self._next_check, self.max_steps + 1)
+
+
 class EvalState:
 
     '''
     Evaluation state.
 
-    level: the current depth of recursion.
-    branch_vars: the variables used in this branch.
+    budget: the EvalBudget limiting this evaluation.
+    level: the current depth of nested variable evaluation.
+    branch_vars: the variables being evaluated in this branch.
     used_vars_ofs: dictionary of first offset where a variable is used.
+    volatile: whether a function returning a different value on every
+    call (e.g. rand_int) was used, which makes the result uncacheable.
+    shared: values of subexpressions that occur more than once.
     '''
 
-    def __init__(self):
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = EvalBudget()
+        self.budget = budget
         self.level = 0
         self.branch_vars = []
         self.used_var_ofs = {}
+        self.volatile = False
+        self.shared = {}
+
+    def enter(self, name):
+        '''Return the state to evaluate the tree stored in variable <name>.'''
+        state = EvalState(self.budget)
+        state.level = self.level + 1
+        state.branch_vars = self.branch_vars + [name]
+        return state
+
+    def merge(self, used_var_ofs, volatile=False):
+        '''Merge the results of a nested evaluation into this state.'''
+        for name, ofs in used_var_ofs.items():
+            if name not in self.used_var_ofs or ofs < self.used_var_ofs[name]:
+                self.used_var_ofs[name] = ofs
+        self.volatile = self.volatile or volatile
 
 
 class AstParser:
@@ -264,15 +364,53 @@ class AstParser:
     _ARG_STRING = 0
     _ARG_NODE = 1
 
+    # Maximum number of parse trees kept by parse()
+    PARSE_CACHE_SIZE = 256
+
+    # Default limits for one evaluation, see set_limits()
+    MAX_TIME = 5.0
+    MAX_STEPS = 5000000
+    MAX_INT_BITS = 2 ** 22
+
     BUILTIN_VARS = {
         'True': True,
         'False': False,
     }
 
-    def __init__(self, ml=None, pl=None):
+    def __init__(self, ml=None, pl=None, max_time=MAX_TIME,
+                 max_steps=MAX_STEPS, max_int_bits=MAX_INT_BITS):
         self._namespace = {}
+        self._plugins = []
+        self._budget = None
         self._immutable_vars = []
         self._used_var_ofs = {}
+        self._vector_funcs = {}
+        self._vector_func_loaders = []
+        self._numpy = None
+        self._volatile_funcs = []
+        self._angle_funcs = []
+
+        # Float values and Decimal functions of the constants that are
+        # replaced by more precise values in precision mode
+        self._precise_constants = {}
+        self.precision = None
+
+        # Cached values of labelled equations, with the settings they were
+        # computed for, and the dependency graph between variables, used to
+        # only recompute what changed.
+        self._var_values = {}
+        self._var_deps = {}
+        self._var_users = {}
+        self._var_versions = {}
+
+        # Labelled equations whose values were cached since the last
+        # pop_var_values(), to copy them back from a worker process
+        self._var_values_added = set()
+        self._last_volatile = False
+
+        self._parse_cache = OrderedDict()
+        self.parse_cache_hits = 0
+        self.parse_cache_misses = 0
 
         if ml is None:
             self.ml = MathLib()
@@ -293,13 +431,37 @@ class AstParser:
         self._special_func_args = {
             (self._helper.get_help, 0): self._ARG_STRING,
             (self.pl.plot, 0): self._ARG_NODE,
+            (self.diff, 0): self._ARG_NODE,
+            (self.diff, 1): self._ARG_STRING,
+            (self._diff_vector, 0): self._ARG_NODE,
+            (self._diff_vector, 1): self._ARG_STRING,
         }
 
         # Plug-in plot function
         self.set_var('plot', self.pl.plot, immutable=True)
         self._helper.add_help('plot', PLOTHELP)
 
+        # Symbolic derivatives
+        self._differentiator = Differentiator(self)
+        self.set_var('diff', self.diff, immutable=True)
+        self._helper.add_help('diff', DIFFHELP)
+        self._vector_funcs[self.diff] = self._diff_vector
+
+        # Numeric solving, minimisation and integration
+        self.solver = Solver(self)
+        self.set_var('solve', self.solver.solve, immutable=True)
+        self._helper.add_help('solve', SOLVEHELP)
+        self.set_var('minimize', self.solver.minimize, immutable=True)
+        self._helper.add_help('minimize', MINIMIZEHELP)
+        self.set_var('integrate', self.solver.integrate, immutable=True)
+        self._helper.add_help('integrate', INTEGRATEHELP)
+        self._special_func_args[(self.solver.solve, 0)] = self._ARG_NODE
+        self._special_func_args[(self.solver.minimize, 0)] = self._ARG_NODE
+        self._special_func_args[(self.solver.integrate, 0)] = self._ARG_NODE
+
         self._load_plugins()
+        self.set_limits(max_time, max_steps, max_int_bits)
+        self.set_precision(None)
 
         # Redirect operations to registered functions
         for key, val in self.UNARYOP_MAP.items():
@@ -323,12 +485,71 @@ class AstParser:
         plugins = ('functions', 'constants')
         for plugin in plugins:
             try:
-                items = inspect.getmembers(importlib.import_module(plugin))
+                module = importlib.import_module(plugin)
+                self._plugins.append(module)
+                items = inspect.getmembers(module)
                 self._load_plugin_items(items)
+                if hasattr(module, '_get_vector_funcs'):
+                    self._vector_func_loaders.append(
+                        module._get_vector_funcs)
+                self._volatile_funcs.extend(
+                    getattr(module, '_VOLATILE_FUNCS', ()))
+                self._angle_funcs.extend(
+                    getattr(module, '_ANGLE_FUNCS', ()))
+                for name, func in getattr(module, '_PRECISE_CONSTANTS',
+                                          {}).items():
+                    self._precise_constants[name] = \
+                        (getattr(module, name), func)
 
             except Exception as e:
                 logging.error('Error loading plugin: %s', e)
 
+    def set_limits(self, max_time=None, max_steps=None, max_int_bits=None):
+        '''
+        Limit the wall-clock time (in seconds), the number of evaluated
+        operations and the size in bits of integer results of an
+        evaluation. None means unlimited. A calculation exceeding the limits
+        is aborted with an error.
+        '''
+        self.max_time = max_time
+        self.max_steps = max_steps
+        self.max_int_bits = max_int_bits
+        for module in self._plugins:
+            if hasattr(module, '_set_max_int_bits'):
+                module._set_max_int_bits(max_int_bits)
+
+    def set_precision(self, digits):
+        '''
+        Calculate with <digits> significant digits, using Decimals where
+        floats are not precise enough, or with floats if <digits> is None.
+        '''
+        self.precision = None
+        for module in self._plugins:
+            if hasattr(module, '_set_precision'):
+                module._set_precision(digits)
+                self.precision = module._precision.value
+
+        for name, (value, func) in self._precise_constants.items():
+            if self.precision is not None:
+                value = func(self.precision)
+            self._set_constant(name, value)
+
+        # Number literals are parsed differently in precision mode, and
+        # compiled labelled equations hold constants folded with the old
+        # precision
+        self.clear_parse_cache()
+        self._var_values.clear()
+        for value in self._namespace.values():
+            if type(value) in (ast.Expression, ast.Expr):
+                value.__dict__.pop('_compiled', None)
+                value.__dict__.pop('_compiled_vector', None)
+
+    def _set_constant(self, name, value):
+        '''Change the value of constant <name>, e.g. to a more precise one.'''
+        self._namespace[name] = value
+        self._var_versions[name] = self._var_versions.get(name, 0) + 1
+        self._invalidate_var(name)
+
     def log_debug_info(self):
         logging.debug('Variables:')
         for name in self.get_variable_names():
@@ -352,8 +573,164 @@ class AstParser:
         self._namespace[str(name)] = value
         if immutable:
             self._immutable_vars.append(name)
+
+        self._var_versions[name] = self._var_versions.get(name, 0) + 1
+        self._invalidate_var(name)
+        for dep in self._var_deps.pop(name, ()):
+            self._var_users[dep].discard(name)
+        if type(value) in (ast.Expression, ast.Expr):
+            deps = set([node.id for node in ast.walk(value)
+                        if isinstance(node, ast.Name)])
+            self._var_deps[name] = deps
+            for dep in deps:
+                self._var_users.setdefault(dep, set()).add(name)
+
         return True
 
+    def get_dependent_vars(self, name):
+        '''
+        Return the labelled equations that use variable <name>, directly
+        or through other labelled equations.
+        '''
+        ret = []
+        todo = [str(name)]
+        while len(todo) > 0:
+            for user in self._var_users.get(todo.pop(), ()):
+                if user not in ret:
+                    ret.append(user)
+                    todo.append(user)
+        return ret
+
+    def get_var_version(self, name):
+        '''
+        Return a number that changes every time variable <name> is set,
+        0 if it was never set.
+        '''
+        return self._var_versions.get(str(name), 0)
+
+    def get_tree_vars(self, tree):
+        '''
+        Return the names used in <tree>, directly or through the labelled
+        equations it uses.
+        '''
+        todo = [node.id for node in ast.walk(tree)
+                if isinstance(node, ast.Name)]
+        ret = set()
+        while len(todo) > 0:
+            name = todo.pop()
+            if name not in ret:
+                ret.add(name)
+                todo.extend(self._var_deps.get(name, ()))
+        return ret
+
+    def is_volatile(self, name):
+        '''
+        Return whether variable <name> is a function that can return a
+        different value each time it is called, such as rand_float.
+        '''
+        func = self.get_var(name)
+        return any([func is f for f in self._volatile_funcs])
+
+    def _invalidate_var(self, name):
+        self._var_values.pop(name, None)
+        if name in self._var_users:
+            for user in self.get_dependent_vars(name):
+                self._var_values.pop(user, None)
+
+    def get_var_value(self, name):
+        '''
+        Return the value of variable <name>; labelled equations are
+        evaluated, using the cached value if nothing they depend on changed.
+        '''
+        name = str(name)
+        var = self.get_var(name)
+        if type(var) not in (ast.Expression, ast.Expr):
+            return var
+        outer_budget = self._budget
+        if outer_budget is None:
+            self._set_budget(EvalBudget(self.max_time, self.max_steps))
+        try:
+            return self._eval_var(name, var, EvalState(self._budget))
+        finally:
+            if outer_budget is None:
+                self._set_budget(None)
+
+    def _set_budget(self, budget):
+        '''
+        Set the budget of the outermost evaluation. Plug-ins get its
+        deadline, so that functions with long loops can stop in time.
+        '''
+        self._budget = budget
+        deadline = budget.deadline if budget is not None else None
+        for module in self._plugins:
+            if hasattr(module, '_set_deadline'):
+                module._set_deadline(deadline)
+
+    def _value_key(self):
+        '''
+        Return the settings, other than variables, that the value of a
+        labelled equation depends on: the angle unit and the precision.
+        '''
+        scaling = self.get_var('angle_scaling')
+        return (getattr(scaling, 'value', None), self.precision)
+
+    def _eval_var(self, name, tree, state, vector=False):
+        key = self._value_key()
+        cached = self._var_values.get(name)
+        if cached is not None and cached[2] == key:
+            value, used_var_ofs = cached[:2]
+            state.merge(used_var_ofs)
+            return value
+
+        child = state.enter(name)
+        value = self.compile(tree, vector)(child)
+        state.merge(child.used_var_ofs, child.volatile)
+
+        # Values computed element-wise might differ in type, don't keep them
+        if not child.volatile and not vector:
+            self._var_values[name] = (value, child.used_var_ofs, key)
+            self._var_values_added.add(name)
+        return value
+
+    def cache_var_value(self, name, value):
+        '''
+        Cache <value>, the result of the last evaluation, as the value of
+        labelled equation <name>, which was set to the tree evaluated.
+        '''
+        name = str(name)
+        if not self._last_volatile:
+            self._var_values[name] = (value, dict(self._used_var_ofs),
+                                      self._value_key())
+            self._var_values_added.add(name)
+
+    def _get_used_versions(self, name, used_var_ofs):
+        names = [name] + list(used_var_ofs.keys())
+        return dict([(n, self._var_versions.get(n, 0)) for n in names])
+
+    def pop_var_values(self):
+        '''
+        Return the values of labelled equations cached since the last call,
+        with the versions of the variables they used, for update_var_values().
+        '''
+        ret = []
+        for name in self._var_values_added:
+            cached = self._var_values.get(name)
+            if cached is not None:
+                ret.append((name, cached,
+                            self._get_used_versions(name, cached[1])))
+        self._var_values_added.clear()
+        return ret
+
+    def update_var_values(self, items):
+        '''
+        Store the values returned by pop_var_values() of a copy of this
+        parser, such as that of a worker process, if the variables they
+        used have the same versions here.
+        '''
+        for name, cached, versions in items:
+            if versions == self._get_used_versions(name, cached[1]):
+                self._var_values[name] = cached
+
     def get_var(self, name):
         '''Return variable value, or None if non-existent.'''
         return self._namespace.get(str(name), None)
@@ -412,7 +789,33 @@ class AstParser:
     def get_pre_operators(self):
         return self.PRE_OPS
 
-    def _resolve_arg(self, func, index, arg, state):
+    def get_numpy(self):
+        '''
+        Return the NumPy module, or None if it is not installed. NumPy and
+        the element-wise functions of the plug-ins are loaded on the first
+        call, as importing NumPy would make up most of the start-up time.
+        '''
+
+        if self._numpy is None:
+            try:
+                import numpy
+                self._numpy = numpy
+            except ImportError:
+                self._numpy = False
+            if self._numpy:
+                for loader in self._vector_func_loaders:
+                    self._vector_funcs.update(loader())
+        return self._numpy or None
+
+    def _get_vector_func(self, func):
+        '''Return the element-wise counterpart of function <func>.'''
+        try:
+            return self._vector_funcs[func]
+        except (KeyError, TypeError):
+            name = getattr(func, '__name__', str(func))
+            raise ArgumentError(_("No element-wise version of '%s'") % name)
+
+    def _resolve_arg(self, func, index, arg, code, state):
         funcarg = (func, index)
         if funcarg in self._special_func_args:
             val = self._special_func_args[funcarg]
@@ -426,134 +829,254 @@ class AstParser:
                 else:
                     logging.error('Unable to resolve special arg %r', arg)
         else:
-            return self._process_node(arg, state)
+            return code(state)
+
+    def _mark_shared(self, nodes):
+        '''
+        Mark the subexpressions that occur more than once in <nodes>, such
+        as sin(x) in (sin(x)**2, 2*sin(x)), so that they are evaluated only
+        once per evaluation.
+        '''
+
+        found = {}
+        for node in nodes:
+            for sub in ast.walk(node):
+                sub._shared_key = None
+                if isinstance(sub, (ast.BinOp, ast.UnaryOp, ast.Call)):
+                    found.setdefault(ast.dump(sub), []).append(sub)
+
+        for key, subs in found.items():
+            if len(subs) < 2:
+                continue
+            # Labelled equations using e.g. rand_float() are volatile too
+            names = self.get_tree_vars(subs[0])
+            if any([self.is_volatile(name) for name in names]):
+                continue
+            for sub in subs:
+                sub._shared_key = key
+
+    def _compile_node(self, node, isfunc=False, vector=False, share=True):
+        '''
+        Translate <node> into a closure taking an EvalState, which returns
+        the value of the node when called. If <vector> is True, functions
+        are replaced by their element-wise counterparts so that variables
+        may hold arrays.
+        '''
 
-    def _process_node(self, node, state, isfunc=False):
-        # Copy state, list objects will remain the same
-        state = copy.copy(state)
-        state.level += 1
         ofs = getattr(node, 'col_offset', 0)
+        key = getattr(node, '_shared_key', None)
 
-        if node is None:
-            return None
+        if share and key is not None:
+            code = self._compile_node(node, isfunc, vector, share=False)
+
+            def shared(state):
+                try:
+                    return state.shared[key]
+                except KeyError:
+                    # A label may have become volatile since compiling
+                    volatile = state.volatile
+                    state.volatile = False
+                    val = code(state)
+                    if not state.volatile:
+                        state.shared[key] = val
+                    state.volatile = state.volatile or volatile
+                    return val
+
+            return shared
+
+        elif node is None:
+            return lambda state: None
 
         elif isinstance(node, ast.Expression):
-            return self._process_node(node.body, state)
+            return self._compile_node(node.body, vector=vector)
 
         elif isinstance(node, ast.Expr):
-            return self._process_node(node.value, state)
+            return self._compile_node(node.value, vector=vector)
 
         elif isinstance(node, ast.BinOp):
-            left = self._process_node(node.left, state)
-            right = self._process_node(node.right, state)
-            if left is None or right is None:
-                return None
+            left = self._compile_node(node.left, vector=vector)
+            right = self._compile_node(node.right, vector=vector)
             func = self.BINOP_MAP[type(node.op)]
-            try:
-                return func(left, right)
-            except Exception as e:
-                raise RuntimeError(str(e), node.right.col_offset - 1, "")
+            if vector:
+                func = self._get_vector_func(func)
+            err_ofs = node.right.col_offset - 1
+
+            def binop(state):
+                lval = left(state)
+                rval = right(state)
+                if lval is None or rval is None:
+                    return None
+                state.budget.step(err_ofs)
+                try:
+                    return func(lval, rval)
+                except Exception as e:
+                    raise RuntimeError(str(e), err_ofs, "")
+
+            return binop
 
         elif isinstance(node, ast.UnaryOp):
-            operand = self._process_node(node.operand, state)
-            if operand is None:
-                return None
+            operand = self._compile_node(node.operand, vector=vector)
             func = self.UNARYOP_MAP[type(node.op)]
-            return func(operand)
+
+            def unaryop(state):
+                val = operand(state)
+                if val is None:
+                    return None
+                return func(val)
+
+            return unaryop
 
         elif isinstance(node, ast.Compare):
-            left = self._process_node(node.left, state)
-            right = self._process_node(node.comparators[0], state)
+            left = self._compile_node(node.left, vector=vector)
+            right = self._compile_node(node.comparators[0], vector=vector)
             func = self.CMPOP_MAP[type(node.ops[0])]
-            return func(left, right)
+            return lambda state: func(left(state), right(state))
 
         elif isinstance(node, ast.Call):
-            func = self._process_node(node.func, state, isfunc=True)
-            if func is None:
-                return None
-
-            args = [self._resolve_arg(func, i, node.args[i], state)
-                    for i in range(len(node.args))]
-
-            kwargs = {}
-            for i in range(len(node.keywords)):
-                key = node.keywords[i].arg
-                val = self._process_node(node.keywords[i].value, state)
-                if key is None or val is None:
+            func_code = self._compile_node(node.func, isfunc=True,
+                                           vector=vector)
+            args = [(arg, self._compile_node(arg, vector=vector))
+                    for arg in node.args]
+            keywords = [(kw.arg, self._compile_node(kw.value, vector=vector))
+                        for kw in node.keywords]
+            volatile = False
+            if isinstance(node.func, ast.Name):
+                func = self.get_var(node.func.id)
+                volatile = any([func is f for f in self._volatile_funcs])
+            end = getattr(node, 'end_col_offset', None)
+
+            def call(state):
+                func = func_code(state)
+                if func is None:
                     return None
-                kwargs[key] = val
+                if volatile:
+                    state.volatile = True
+                state.budget.step(ofs)
+                if vector:
+                    func = self._get_vector_func(func)
+
+                argvals = [self._resolve_arg(func, i, arg, code, state)
+                           for i, (arg, code) in enumerate(args)]
+
+                kwargs = {}
+                for key, code in keywords:
+                    val = code(state)
+                    if key is None or val is None:
+                        return None
+                    kwargs[key] = val
 
-            try:
-                ret = func(*args, **kwargs)
-                return ret
-            except Exception as e:
-                msg = str(e)
-                raise ArgumentError(msg)
+                try:
+                    return func(*argvals, **kwargs)
+                except LimitError as e:
+                    # Functions stopping at the deadline do not know where
+                    # they were called
+                    if not e.positioned:
+                        e.set_range(ofs, end)
+                        e.positioned = True
+                    raise
+                except Exception as e:
+                    msg = str(e)
+                    raise ArgumentError(msg)
+
+            return call
 
         elif isinstance(node, ast.Num):
-            return node.n
+            value = node.n
+            return lambda state: value
 
         elif isinstance(node, ast.Str):
-            return node.s
+            value = node.s
+            return lambda state: value
+
+        elif isinstance(node, (ast.NameConstant, ast.Constant)):
+            value = node.value
+            return lambda state: value
 
         elif isinstance(node, ast.Tuple):
-            ls = [self._process_node(i, state) for i in node.elts]
-            return tuple(ls)
+            self._mark_shared(node.elts)
+            elts = [self._compile_node(i, vector=vector) for i in node.elts]
+            return lambda state: tuple([code(state) for code in elts])
 
         elif isinstance(node, ast.Name):
-            if not isfunc and node.id in ('help', _('help')):
-                return self._helper.get_help()
-
-            elif node.id in self._namespace:
-                if not isfunc:
-                    # Check whether variable was already used in this branch
-                    if node.id in state.branch_vars:
-                        raise RuntimeError(_('Recursion detected'), ofs, "")
-                    state.branch_vars = copy.copy(state.branch_vars)
-
-                    # Update where variable is first used
-                    if node.id not in list(state.used_var_ofs.keys()):
-                        state.used_var_ofs[node.id] = node.col_offset
-                    elif node.col_offset < state.used_var_ofs[node.id]:
-                        state.used_var_ofs[node.id] = node.col_offset
-
-                var = self.get_var(node.id)
-                try:
-                    if type(var) is ast.Expression:
-                        return self._process_node(var.body, state)
-                    elif type(var) is ast.Expr:
-                        return self._process_node(var.value, state)
-                    else:
-                        return var
-                except ParserError as e:
-                    logging.debug('error: %r', e)
-                    e.set_range(ofs, ofs + len(node.id))
-                    raise e
-
-            else:
-                if isfunc:
-                    msg = _("Function '%s' not defined") % (node.id)
-                else:
-                    msg = _("Variable '%s' not defined") % (node.id)
-                raise RuntimeError(msg, ofs, node.id, ofs + len(node.id))
+            return self._compile_name(node, isfunc, vector)
 
         elif isinstance(node, ast.Attribute):
-            parent = self._process_node(node.value, state)
-            if parent:
-                try:
-                    val = parent.__dict__[node.attr]
-                    return val
-                except Exception as e:
-                    msg = _("Attribute '%s' does not exist") % node.value
-                    raise RuntimeError(msg, ofs, node.value,
-                                       ofs + len(node.value))
+            value = self._compile_node(node.value, vector=vector)
+            attr = node.attr
+
+            def attribute(state):
+                parent = value(state)
+                if parent:
+                    try:
+                        return parent.__dict__[attr]
+                    except Exception:
+                        msg = _("Attribute '%s' does not exist") % node.value
+                        raise RuntimeError(msg, ofs, node.value,
+                                           ofs + len(node.value))
+                return None
 
-            return None
+            return attribute
 
         else:
             logging.debug('Unknown node: %r', repr(node))
 
-        return None
+        return lambda state: None
+
+    def _compile_name(self, node, isfunc, vector):
+        name = node.id
+        ofs = node.col_offset
+
+        if not isfunc and name in ('help', _('help')):
+            return lambda state: self._helper.get_help()
+
+        if isfunc:
+            msg = _("Function '%s' not defined") % (name)
+        else:
+            msg = _("Variable '%s' not defined") % (name)
+
+        def lookup(state):
+            if name not in self._namespace:
+                raise RuntimeError(msg, ofs, name, ofs + len(name))
+
+            if not isfunc:
+                # Check whether variable was already used in this branch
+                if name in state.branch_vars:
+                    raise RuntimeError(_('Recursion detected'), ofs, "")
+
+                # Update where variable is first used
+                used_var_ofs = state.used_var_ofs
+                if name not in used_var_ofs or ofs < used_var_ofs[name]:
+                    used_var_ofs[name] = ofs
+
+            var = self._namespace[name]
+            if type(var) not in (ast.Expression, ast.Expr):
+                return var
+
+            try:
+                return self._eval_var(name, var, state, vector)
+            except ParserError as e:
+                logging.debug('error: %r', e)
+                e.set_range(ofs, ofs + len(name))
+                raise e
+
+        return lookup
+
+    def compile(self, tree, vector=False):
+        '''
+        Compile a parse tree into a closure that can be called with an
+        EvalState. The result is cached on the tree, so evaluating the same
+        tree again (plots, labelled variables) skips the tree walk.
+        '''
+
+        attr = '_compiled_vector' if vector else '_compiled'
+        code = getattr(tree, attr, None)
+        if code is None:
+            if vector:
+                self.get_numpy()
+            code = self._compile_node(self.fold_constants(tree),
+                                      vector=vector)
+            setattr(tree, attr, code)
+        return code
 
     def walk_replace_node(self, node, func, level=0):
         '''
@@ -566,6 +1089,15 @@ class AstParser:
         items only.
         '''
 
+        # The tree may change, so it can no longer be handed out by parse()
+        # and its compiled form is stale
+        if level == 0:
+            self._uncache_tree(node)
+        if isinstance(node, ast.AST):
+            node.__dict__.pop('_compiled', None)
+            node.__dict__.pop('_compiled_vector', None)
+            node.__dict__.pop('_derivatives', None)
+
         if hasattr(node, '_fields') and node._fields is not None:
             for field in node._fields:
                 fieldval = getattr(node, field)
@@ -594,30 +1126,187 @@ class AstParser:
 
         self.walk_replace_node(tree, func)
 
-    def _parse_func(self, node, level):
-        if isinstance(node, ast.BinOp):
-            if isinstance(node.left, ast.Num) and isinstance(node.right,
-                                                             ast.Num):
+    def _const_value(self, node):
+        '''
+        Return (True, value) if <node> is a constant, otherwise (False, None).
+        Names of constants, such as True, count as constants too, except
+        those that set_precision() changes, such as pi.
+        '''
+
+        if isinstance(node, ast.Num):
+            return (True, node.n)
+        elif isinstance(node, ast.Str):
+            return (True, node.s)
+        elif isinstance(node, (ast.NameConstant, ast.Constant)):
+            return (True, node.value)
+        elif isinstance(node, ast.Name) and \
+                node.id in self._immutable_vars and \
+                node.id not in self._precise_constants:
+            value = self.get_var(node.id)
+            if not callable(value) and not isinstance(value, type):
+                return (True, value)
+        return (False, None)
+
+    def _is_foldable_func(self, func):
+        '''
+        Return whether calls to <func> with constant arguments always give
+        the same result, so they can be evaluated once.
+        '''
+
+        if not isinstance(func, (types.FunctionType,
+                                 types.BuiltinFunctionType)):
+            return False
+        for funcs in (self._volatile_funcs, self._angle_funcs,
+                      [f for (f, i) in self._special_func_args]):
+            if any([func is f for f in funcs]):
+                return False
+        return True
+
+    def _fold_value(self, node, func, args):
+        '''
+        Return a constant node with the value of func(*args), or <node> if
+        it can not be computed now; errors are left to the evaluation.
+        '''
+
+        try:
+            value = func(*args)
+        except Exception:
+            return node
+        if value is None or callable(value):
+            return node
+        return ast.copy_location(ast.Constant(value=value), node)
+
+    def fold_constants(self, node):
+        '''
+        Return a copy of tree <node> in which constant subexpressions are
+        replaced by their value: operators and calls of functions with
+        constant arguments, e.g. 2*3 or sqrt(2). Variables, labelled
+        equations and functions like rand_int() or sin() (which depends on
+        the angle setting) are kept. Unchanged subtrees are shared with
+        <node>, which is not modified.
+        '''
+
+        if isinstance(node, ast.Expression):
+            body = self.fold_constants(node.body)
+            if body is node.body:
+                return node
+            return ast.copy_location(ast.Expression(body=body), node)
+
+        elif isinstance(node, ast.Expr):
+            value = self.fold_constants(node.value)
+            if value is node.value:
+                return node
+            return ast.copy_location(ast.Expr(value=value), node)
+
+        elif isinstance(node, ast.BinOp):
+            left = self.fold_constants(node.left)
+            right = self.fold_constants(node.right)
+            lconst, lval = self._const_value(left)
+            rconst, rval = self._const_value(right)
+            if lconst and rconst:
                 func = self.BINOP_MAP[type(node.op)]
-                ans = func(node.left.n, node.right.n)
-                ret = ast.Num()
-                ret.n = ans
-                return ret
-            else:
-                return None
-        elif isinstance(node, ast.Name):
-            if node.id in self._namespace:
-                var = self.get_var(node.id)
-                ret = ast.Num()
-                ret.n = var
-                return ret
+                return self._fold_value(node, func, (lval, rval))
+            if left is node.left and right is node.right:
+                return node
+            return ast.copy_location(
+                ast.BinOp(left=left, op=node.op, right=right), node)
+
+        elif isinstance(node, ast.UnaryOp):
+            operand = self.fold_constants(node.operand)
+            const, val = self._const_value(operand)
+            if const:
+                func = self.UNARYOP_MAP[type(node.op)]
+                return self._fold_value(node, func, (val,))
+            if operand is node.operand:
+                return node
+            return ast.copy_location(
+                ast.UnaryOp(op=node.op, operand=operand), node)
+
+        elif isinstance(node, ast.Compare):
+            left = self.fold_constants(node.left)
+            right = self.fold_constants(node.comparators[0])
+            lconst, lval = self._const_value(left)
+            rconst, rval = self._const_value(right)
+            if lconst and rconst:
+                func = self.CMPOP_MAP[type(node.ops[0])]
+                return self._fold_value(node, func, (lval, rval))
+            if left is node.left and right is node.comparators[0]:
+                return node
+            return ast.copy_location(
+                ast.Compare(left=left, ops=node.ops, comparators=[right]),
+                node)
+
+        elif isinstance(node, ast.Call):
+            args = [self.fold_constants(arg) for arg in node.args]
+            keywords = [ast.keyword(arg=kw.arg,
+                                    value=self.fold_constants(kw.value))
+                        for kw in node.keywords]
+            if isinstance(node.func, ast.Name) and \
+                    node.func.id in self._immutable_vars and \
+                    len(keywords) == 0:
+                func = self.get_var(node.func.id)
+                consts = [self._const_value(arg) for arg in args]
+                if self._is_foldable_func(func) and \
+                        all([const for (const, val) in consts]):
+                    return self._fold_value(
+                        node, func, [val for (const, val) in consts])
+            if all([a is b for (a, b) in zip(args, node.args)]) and \
+                    all([kw.value is old.value
+                         for (kw, old) in zip(keywords, node.keywords)]):
+                return node
+            return ast.copy_location(
+                ast.Call(func=node.func, args=args, keywords=keywords), node)
+
+        elif isinstance(node, ast.Tuple):
+            elts = [self.fold_constants(elt) for elt in node.elts]
+            if all([a is b for (a, b) in zip(elts, node.elts)]):
+                return node
+            return ast.copy_location(ast.Tuple(elts=elts, ctx=node.ctx), node)
+
+        return node
+
+    def differentiate(self, tree, var):
+        '''
+        Return the derivative of <tree> with respect to variable <var> as a
+        new tree. The derivative is cached on <tree> and only computed again
+        if a variable used by <tree> (other than <var>) or the angle setting
+        changes, so it can be evaluated at many points cheaply.
+        '''
+
+        scaling = self.get_var('angle_scaling')
+        versions = tuple([(name, self.get_var_version(name))
+                          for name in sorted(self.get_tree_vars(tree))
+                          if name != var])
+        key = (var, getattr(scaling, 'value', None), versions)
+
+        cache = tree.__dict__.setdefault('_derivatives', {})
+        ret = cache.get(key)
+        if ret is None:
+            ret = self._differentiator.differentiate(tree, var)
+            cache.clear()
+            cache[key] = ret
+        return ret
+
+    def diff(self, eqn, var, vector=False):
+        '''
+        Differentiate <eqn> with respect to <var>. Returns the value of the
+        derivative if <var> has a value, otherwise the derivative as text.
+        '''
+
+        tree = self.differentiate(eqn, var)
+        if self.get_var(var) is None:
+            return tree_to_str(tree)
+        return self.evaluate(tree, vector=vector)
+
+    def _diff_vector(self, eqn, var):
+        return self.diff(eqn, var, vector=True)
 
     def parse_symbolic(self, tree):
         '''
         Reduce an abstract syntax tree until it contains only numbers and
-        unresolved symbols.
+        unresolved symbols. Returns the reduced tree, <tree> is unchanged.
         '''
-        self.walk_replace_node(tree, self._parse_func)
+        return self.fold_constants(tree)
 
     def _preprocess_eqn(self, eqn):
         eqn = str(eqn)
@@ -629,11 +1318,40 @@ class AstParser:
 
         return eqn
 
+    def _uncache_tree(self, tree):
+        key = getattr(tree, '_parse_key', None)
+        if key is not None and self._parse_cache.get(key) is tree:
+            del self._parse_cache[key]
+
+    def clear_parse_cache(self):
+        '''Forget all cached parse trees.'''
+        self._parse_cache.clear()
+
     def parse(self, eqn):
         '''
         Parse an equation and return a parse tree.
+
+        Trees are cached by equation text, so parsing the same equation
+        again returns the same tree. It should be treated as read-only;
+        walk_replace_node() takes it out of the cache before changing it.
         '''
 
+        key = str(eqn)
+        tree = self._parse_cache.get(key)
+        if tree is not None:
+            self._parse_cache.move_to_end(key)
+            self.parse_cache_hits += 1
+            return tree
+
+        self.parse_cache_misses += 1
+        tree = self._parse(eqn)
+        tree._parse_key = key
+        self._parse_cache[key] = tree
+        if len(self._parse_cache) > self.PARSE_CACHE_SIZE:
+            self._parse_cache.popitem(last=False)
+        return tree
+
+    def _parse(self, eqn):
         eqn = self._preprocess_eqn(eqn)
         logging.debug('Parsing preprocessed equation: %r', eqn)
 
@@ -655,32 +1373,58 @@ class AstParser:
             if len(tree.body) != 1:
                 msg = _("Multiple statements not supported")
                 raise ParseError(msg, 0, eqn)
-            return tree.body[0]
+            tree = tree.body[0]
 
+        if self.precision is not None:
+            self._decimal_literals(tree, eqn)
         return tree
 
-    def evaluate(self, eqn):
+    def _decimal_literals(self, tree, eqn):
+        '''
+        Replace float literals in <tree> by Decimals with all the digits
+        written in <eqn>.
+        '''
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and \
+                    isinstance(node.value, float):
+                try:
+                    node.value = Decimal(ast.get_source_segment(eqn, node))
+                except Exception:
+                    node.value = Decimal(repr(node.value))
+
+    def evaluate(self, eqn, vector=False):
         '''
         Evaluate an equation or parse tree.
+
+        If <vector> is True, variables may be NumPy arrays and the equation
+        is evaluated element-wise; an ArgumentError is raised if it uses a
+        function that has no element-wise version.
         '''
 
         if type(eqn) in (bytes, str):
             eqn = self.parse(eqn)
 
-        state = EvalState()
+        # Nested evaluations, e.g. by plot(), share the budget of the
+        # outermost one
+        outer_budget = self._budget
+        if outer_budget is None:
+            self._set_budget(EvalBudget(self.max_time, self.max_steps))
+
+        state = EvalState(self._budget)
         try:
-            if isinstance(eqn, ast.Expression):
-                ret = self._process_node(eqn.body, state)
-            else:
-                ret = self._process_node(eqn, state)
+            ret = self.compile(eqn, vector)(state)
         except (RuntimeError, ParserError) as e:
             raise e
         except Exception as e:
             logging.error('Internal error (%s): %s', type(e), str(e))
             msg = _('Internal error')
             raise ParseError(msg, 0, eqn)
+        finally:
+            if outer_budget is None:
+                self._set_budget(None)
 
         self._used_var_ofs = state.used_var_ofs
+        self._last_volatile = state.volatile
 
         if isinstance(ret, types.FunctionType):
             return ret()
@@ -728,7 +1472,7 @@ if __name__ == '__main__':
     print('Tree before:')
     p.print_tree(tree)
 #    p.set_var('apples', 123)
-    p.parse_symbolic(tree)
+    tree = p.parse_symbolic(tree)
 #    num = ast.Num()
 #    num.n = 123
 #    p.replace_variable(tree, 'apples', num)
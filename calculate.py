@@ -29,7 +29,11 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 from gi.repository import Gdk
+from gi.repository import GLib
 import base64
+import multiprocessing
+import re
+import time
 
 import sugar3.profile
 from sugar3.graphics.xocolor import XoColor
@@ -39,6 +43,7 @@ from layout import CalcLayout
 from mathlib import MathLib
 from astparser import AstParser, ParserError, ParseError, RuntimeError
 from svgimage import SVGImage
+from worker import evaluate, evaluate_worker, is_svg
 
 from decimal import Decimal
 from rational import Rational
@@ -62,6 +67,21 @@ def findchar(text, chars, ofs=0):
     return -1
 
 
+_EXPONENT_RE = re.compile(r'(×10\*\*|e)-?\d+$')
+
+
+def _strip_zeros(resstr):
+    '''
+    Remove trailing zeros after the decimal point of a formatted number,
+    leaving the exponent alone, e.g. 1.50000000×10**-20 becomes 1.5×10**-20.
+    '''
+    if '.' not in resstr:
+        return resstr
+    match = _EXPONENT_RE.search(resstr)
+    pos = match.start() if match is not None else len(resstr)
+    return resstr[:pos].rstrip('0').rstrip('.') + resstr[pos:]
+
+
 def _textview_realize_cb(widget):
     '''Change textview properties once window is created.'''
     win = widget.get_window(Gtk.TextWindowType.TEXT)
@@ -92,13 +112,18 @@ class Equation:
 
     def __str__(self):
         if isinstance(self.result, SVGImage):
-            svg_data = "<svg>" + base64.b64encode(self.result.get_svg_data())
+            svg_data = "<svg>" + base64.b64encode(
+                self.result.get_svg_data()).decode('ascii')
             return "%s;%s;%s;%s;%s\n" % \
                 (self.label, self.equation, svg_data,
                  self.color.to_string(), self.owner)
         else:
+            # str() refuses integers of more than 4300 digits
+            result = self.result
+            if type(result) is int:
+                result = self.ml.d(result)
             return "%s;%s;%s;%s;%s\n" % \
-                (self.label, self.equation, self.result,
+                (self.label, self.equation, result,
                  self.color.to_string(), self.owner)
 
     def parse(self, str):
@@ -225,19 +250,18 @@ class Equation:
             eqnend = buf.get_iter_at_offset(eqnoffset + range[1])
             buf.apply_tag(tagred, eqnstart, eqnend)
         elif not isinstance(self.result, SVGImage):
-            resstr = self.ml.format_number(self.result)
-            resstr = str(resstr).rstrip('0').rstrip('.') \
-                if '.' in resstr else resstr
+            resstr = _n(_strip_zeros(self.ml.format_number(self.result)))
             self.append_with_superscript_tags(buf, resstr, tagbigger,
                                               tagjustright)
 
         return buf
 
-    def create_history_object(self):
+    def create_history_object(self, resstr=None):
         """
         Create a history object for this equation.
         In case of an SVG result this will be the image, otherwise it will
         return a properly formatted Gtk.TextView.
+        resstr: the formatted result, if it is already known.
         """
 
         if isinstance(self.result, SVGImage):
@@ -279,9 +303,9 @@ class Equation:
         eqnstr = '%s\n' % str(self.equation)
         self.append_with_superscript_tags(buf, eqnstr, tagsmall)
 
-        resstr = self.ml.format_number(self.result)
-        resstr = str(resstr).rstrip('0').rstrip('.') \
-            if '.' in resstr else resstr
+        if resstr is None:
+            resstr = self.ml.format_number(self.result)
+        resstr = _n(_strip_zeros(resstr))
         if len(resstr) > 30:
             restag = tagsmall
         else:
@@ -336,6 +360,7 @@ class Calculate(ShareableActivity):
         'End': lambda o: o.text_entry.set_position(
             len(o.text_entry.get_text())),
         'Tab': lambda o: o.tab_complete(),
+        'Escape': lambda o: o.cancel_process(),
     }
 
     CTRL_KEYMAP = {
@@ -357,12 +382,16 @@ class Calculate(ShareableActivity):
         "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_ "
 
     def __init__(self, handle):
+        start = time.time()
         ShareableActivity.__init__(self, handle)
 
         self.old_eqs = []
 
+        parser_start = time.time()
         self.ml = MathLib()
         self.parser = AstParser(self.ml)
+        _logger.debug('Startup: creating the parser took %.3f s',
+                      time.time() - parser_start)
 
         # These will result in 'Ans <operator character>' being inserted
         self._chars_ans_diadic = [op[0]
@@ -382,6 +411,10 @@ class Calculate(ShareableActivity):
         self.ans_inserted = False
         self.show_vars = False
 
+        # (process, connection, GLib source id) of a running calculation
+        self._worker = None
+        self._computing_buf = None
+
         self.connect("key_press_event", self.keypress_cb)
         self.connect("destroy", self.cleanup_cb)
         self.color = sugar3.profile.get_color()
@@ -398,12 +431,15 @@ class Calculate(ShareableActivity):
         self.connect('joined', self._joined_cb)
 
         self.parser.log_debug_info()
+        _logger.debug('Startup: activity created in %.3f s',
+                      time.time() - start)
 
     def ignore_key_cb(self, widget, event):
         return True
 
     def cleanup_cb(self, arg):
         _logger.debug('Cleaning up...')
+        self.cancel_process()
 
     def equation_pressed_cb(self, eqn):
         """Callback for when an equation box is clicked."""
@@ -418,8 +454,8 @@ class Calculate(ShareableActivity):
             if type(eqn.result) in (bytes, str):
                 text = ''
             else:
-                text = self.parser.ml.format_number(eqn.result)
-                text = text.rstrip('0').rstrip('.') if '.' in text else text
+                text = _strip_zeros(
+                    self.parser.ml.format_number(eqn.result, full=True))
 
         self.button_pressed(self.TYPE_TEXT, text)
         return True
@@ -448,7 +484,8 @@ class Calculate(ShareableActivity):
         self.old_eqs = []
         self.showing_version = 0
 
-    def add_equation(self, eq, prepend=False, drawlasteq=False, tree=None):
+    def add_equation(self, eq, prepend=False, drawlasteq=False, tree=None,
+                     resstr=None, dep_values=None):
         """
         Insert equation in the history list and set variable if assignment.
         Input:
@@ -458,6 +495,9 @@ class Calculate(ShareableActivity):
             buffer to be added to the history next time an equation is added.
             tree: the parsed tree, this will be used to set the label variable
             so that the equation can be used symbolicaly.
+            resstr: the formatted result, if it is already known.
+            dep_values: the new values of the labelled equations that use
+            the label of this equation, computed by the worker.
             """
         if eq.equation is not None and len(eq.equation) > 0:
             if prepend:
@@ -475,7 +515,11 @@ class Calculate(ShareableActivity):
             self.last_eqn_textview = None
 
         if eq.label is not None and len(eq.label) > 0:
-            w = self.create_var_textview(eq.label, eq.result)
+            if isinstance(eq.result, SVGImage):
+                value = eq.result
+            else:
+                value = _n(self.ml.format_number(eq.result))
+            w = self.create_var_textview(eq.label, value)
             if w is not None:
                 self.layout.add_variable(eq.label, w)
 
@@ -487,9 +531,11 @@ class Calculate(ShareableActivity):
                 eq.result = ParseError(str(e), 0, "")
                 self.set_error_equation(eq)
                 return
+            if dep_values is not None:
+                self.update_variables(dep_values)
 
         own = (eq.owner == self.get_owner_id())
-        w = eq.create_history_object()
+        w = eq.create_history_object(resstr)
         w.connect('button-press-event', lambda w,
                   e: self.equation_pressed_cb(eq))
         if drawlasteq:
@@ -503,71 +549,210 @@ class Calculate(ShareableActivity):
         else:
             self.layout.add_equation(w, own, prepend=not prepend)
 
-    # FIXME: to be implemented
-    def process_async(self, eqn):
-        """Parse and process an equation asynchronously."""
+    def add_equations(self, eqs):
+        """
+        Append a list of equations to the history, e.g. from the journal,
+        formatting all results at once.
+        """
+        resstrs = self.ml.format_many([eq.result for eq in eqs])
+        for eq, resstr in zip(eqs, resstrs):
+            self.add_equation(eq, prepend=False, resstr=resstr)
+
+    def process_async(self, eqn, label=''):
+        """
+        Parse and process an equation asynchronously. The equation is
+        evaluated in a worker process, so that the activity stays responsive
+        and the calculation can be cancelled. The result is handled by
+        process_result() in the main loop.
+        """
+
+        try:
+            tree = self.parser.parse(eqn)
+        except ParserError as e:
+            self.process_result(eqn, label, None, e, {})
+            return
+
+        # If the previous answer was inserted, also evaluate with LastEqn
+        # instead to get a (more) exact result
+        tree2 = None
+        if self.ans_inserted:
+            ansvar = self.format_insert_ans()
+            pos = eqn.find(ansvar)
+            if len(ansvar) > 6 and pos != -1:
+                s2 = eqn.replace(ansvar, 'LastEqn')
+                _logger.debug(
+                    'process(): replacing previous answer %r: %r', ansvar, s2)
+                try:
+                    tree2 = self.parser.parse(s2)
+                except ParserError as e:
+                    _logger.debug('Parsing with LastEqn failed: %s', e)
+
+        # Load the plotting back-end here, so that it is loaded once instead
+        # of in every worker
+        if 'plot' in self.parser.get_tree_vars(tree):
+            self.parser.pl.get_backend()
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            (res, used_var_ofs, res2, plots, dep_values, var_values) = \
+                evaluate(self.parser, tree, tree2, label)
+            self.process_result(eqn, label, tree, res, used_var_ofs, res2,
+                                tree2, dep_values)
+            return
+
+        # A forked worker gets a copy of the parser, including all
+        # variables, without having to send them over.
+        ctx = multiprocessing.get_context('fork')
+        conn, conn2 = ctx.Pipe(duplex=False)
+        worker = ctx.Process(target=evaluate_worker,
+                             args=(self.parser, tree, tree2, label, conn2))
+        worker.daemon = True
+        worker.start()
+        conn2.close()
+
+        source = GLib.io_add_watch(
+            conn.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IOCondition.IN | GLib.IOCondition.HUP,
+            self._worker_cb, eqn, label, tree, tree2)
+        self._worker = (worker, conn, source)
+        self.set_computing(True)
+
+    def _worker_cb(self, fd, condition, eqn, label, tree, tree2):
+        worker, conn, source = self._worker
+        try:
+            (res, used_var_ofs, res2, plots, dep_values, var_values) = \
+                conn.recv()
+        except EOFError:
+            res = RuntimeError(_('Calculation failed'), 0, '')
+            used_var_ofs = {}
+            res2 = None
+            plots = []
+            dep_values = {}
+            var_values = []
+
+        # Keep the plots made by the worker, so they need not be redone
+        self.parser.pl.cache.update(plots)
+
+        conn.close()
+        worker.join()
+        self._worker = None
+        self.set_computing(False)
+
+        self.process_result(eqn, label, tree, res, used_var_ofs, res2, tree2,
+                            dep_values, var_values)
+        return False
+
+    def cancel_process(self):
+        """Cancel a running calculation."""
+
+        if self._worker is None:
+            return False
+
+        _logger.debug('Cancelling calculation')
+        worker, conn, source = self._worker
+        GLib.source_remove(source)
+        worker.terminate()
+        worker.join()
+        conn.close()
+        self._worker = None
+        self.set_computing(False)
+        return True
+
+    def set_computing(self, computing):
+        """Show or hide that a calculation is running."""
+
+        if computing:
+            self._computing_buf = self.layout.last_eq.get_buffer()
+            buf = Gtk.TextBuffer()
+            tag = buf.create_tag(font=CalcLayout.FONT_SMALL_NARROW)
+            buf.insert_with_tags(buf.get_end_iter(),
+                                 _('Computing... (press Esc to cancel)'), tag)
+            self.layout.last_eq.set_buffer(buf)
+        elif self._computing_buf is not None:
+            self.layout.last_eq.set_buffer(self._computing_buf)
+            self._computing_buf = None
 
     def process(self):
         """Parse the equation entered and show the result."""
 
+        if self._worker is not None:
+            _logger.debug('process(): still computing')
+            return True
+
         s = _s(self.text_entry.get_text())
         label = self.label_entry.get_text()
         _logger.debug('process(): parsing %r, label: %r', s, label)
-        try:
-            tree = self.parser.parse(s)
-            res = self.parser.evaluate(tree)
-        except ParserError as e:
-            res = e
+        self.process_async(s, label)
+        return True
+
+    def process_result(self, s, label, tree, res, used_var_ofs, res2=None,
+                       tree2=None, dep_values=None, var_values=None):
+        """
+        Show the result <res> of equation <s> and add it to the history.
+        <used_var_ofs> maps the variables used to their first offset, <res2>
+        is the result of the equation with the previous answer replaced by
+        LastEqn, if that was evaluated. <dep_values> holds the new values of
+        the labelled equations that use <label>, <var_values> the values of
+        labelled equations cached by the worker process.
+        """
+
+        if isinstance(res, ParserError):
             self.showing_error = True
 
-        if isinstance(res, str) and res.find('</svg>') > -1:
+        if is_svg(res):
+            if isinstance(res, str):
+                res = res.encode('utf-8')
             res = SVGImage(data=res)
 
         _logger.debug('Result: %r', res)
 
         # Check whether assigning this label would cause recursion
         if not isinstance(res, ParserError) and len(label) > 0:
-            lastpos = self.parser.get_var_used_ofs(label)
+            lastpos = used_var_ofs.get(label)
             if lastpos is not None:
                 res = RuntimeError(
                     _('Can not assign label: will cause recursion'),
-                    lastpos)
+                    lastpos, s)
 
         # If parsing went ok, see if we have to replace the previous answer
         # to get a (more) exact result
-        if self.ans_inserted and not isinstance(res, ParserError) \
+        if res2 is not None and not isinstance(res, ParserError) \
                 and not isinstance(res, SVGImage):
-            ansvar = self.format_insert_ans()
-            pos = s.find(ansvar)
-            if len(ansvar) > 6 and pos != -1:
-                s2 = s.replace(ansvar, 'LastEqn')
-                _logger.debug(
-                    'process(): replacing previous answer %r: %r', ansvar, s2)
-                tree = self.parser.parse(s2)
-                res = self.parser.evaluate(tree)
+            tree = tree2
+            res = res2
 
         if isinstance(res, ParserError):
             eqn = Equation(label, _n(s), res, self.color,
                            self.get_owner_id(), ml=self.ml)
             self.set_error_equation(eqn)
         else:
-            eqn = Equation(label, _n(s), _n(str(res)), self.color,
+            # Numbers are kept, to be shown by MathLib.format_number()
+            if not isinstance(res, (int, float, Decimal, Rational,
+                                    SVGImage)):
+                res = _n(str(res))
+            eqn = Equation(label, _n(s), res, self.color,
                            self.get_owner_id(), ml=self.ml)
-            self.add_equation(eqn, drawlasteq=True, tree=tree)
-            self.send_message("add_eq", value=str(eqn))
+            self.add_equation(eqn, drawlasteq=True, tree=tree,
+                              dep_values=dep_values)
+            # str(eqn) has all digits of the result, which takes long for
+            # huge integers, only make it when there is someone to send it to
+            if self.get_shared():
+                self.send_message("add_eq", value=str(eqn))
 
-            self.parser.set_var('Ans', eqn.result)
+            self.parser.set_var('Ans', res)
 
             # Setting LastEqn to the parse tree would certainly be faster,
             # however, it introduces recursion problems
-            self.parser.set_var('LastEqn', eqn.result)
+            self.parser.set_var('LastEqn', res)
 
             self.showing_error = False
             self.ans_inserted = False
             self.text_entry.set_text('')
             self.label_entry.set_text('')
 
-        return res is not None
+        # Values the worker computed with variables that are set the same
+        # way here, such as <label>, are kept for the next evaluation
+        if var_values is not None:
+            self.parser.update_var_values(var_values)
 
     def create_var_textview(self, name, value):
         """Create a Gtk.TextView for a variable."""
@@ -610,6 +795,19 @@ class Calculate(ShareableActivity):
 
         return w
 
+    def update_variables(self, values):
+        """
+        Show the new values of labelled equations, given as a dictionary.
+        They are evaluated with the equation they depend on, in the worker
+        process, so that the main loop does not block.
+        """
+
+        for name, value in values.items():
+            w = self.create_var_textview(
+                name, _n(self.ml.format_number(value)))
+            if w is not None:
+                self.layout.add_variable(name, w)
+
     def clear(self):
         self.text_entry.set_text('')
         self.text_entry.grab_focus()
@@ -672,9 +870,8 @@ class Calculate(ShareableActivity):
                 self.text_entry.select_region(int(k[2]), int(k[3]))
 
             self.clear_equations()
-            for str in f:
-                eq = Equation(eqnstr=str, ml=self.ml)
-                self.add_equation(eq, prepend=False)
+            self.add_equations([Equation(eqnstr=str, ml=self.ml)
+                                for str in f])
 
             return True
         else:
@@ -954,9 +1151,9 @@ class Calculate(ShareableActivity):
             self.send_message("sync", value=data)
         elif msg == "sync":
             self.clear_equations()
-            for eq_str in value:
-                _logger.debug('receive_message: %s', str(eq_str))
-                self.add_equation(Equation(eqnstr=str(eq_str)), ml=self.ml)
+            _logger.debug('receive_message: %d equations', len(value))
+            self.add_equations([Equation(eqnstr=str(eq_str), ml=self.ml)
+                                for eq_str in value])
 
     def _joined_cb(self, gobj):
         _logger.debug('Requesting synchronization')
@@ -964,10 +1161,20 @@ class Calculate(ShareableActivity):
 
     def format_insert_ans(self):
         ans = self.parser.get_var('Ans')
+
+        # The full text of a huge answer is slow to show and too long to
+        # be parsed again, refer to it by name instead
+        if isinstance(ans, Rational):
+            big = self.ml.is_big_int(ans.n) or self.ml.is_big_int(ans.d)
+        else:
+            big = self.ml.is_big_int(ans)
+        if big:
+            return 'Ans'
+
         if isinstance(ans, Rational):
             return str(ans)
         elif ans is not None:
-            return self.ml.format_number(ans)
+            return self.ml.format_number(ans, full=True)
         else:
             return ''
 
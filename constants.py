@@ -17,15 +17,29 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import math as _math
+import decmath as _decmath
 
 pi = _math.pi        # 3.1415926535
 e = _math.exp(1)     # 2.7182818284590451
+ln2 = _math.log(2)   # 0.6931471805599453
+golden_ratio = (1 + _math.sqrt(5)) / 2
 
 
 class math:
     golden_ratio = 1.61803398874989484820458683436563811
 
 
+# Constants that get more digits when calculating with a precision (see
+# AstParser.set_precision), with a function returning them as a Decimal
+# with a given number of digits. The values are cached per precision.
+_PRECISE_CONSTANTS = {
+    'pi': _decmath.pi,
+    'e': _decmath.e,
+    'ln2': _decmath.ln2,
+    'golden_ratio': _decmath.golden_ratio,
+}
+
+
 class physics:
     c = 299792458               # Speed of light (in vacuum)
     h = 6.6260689633e-34        # Planck's constant
@@ -0,0 +1,375 @@
+# decmath.py, mathematical functions on Decimals with a given precision
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# The functions in this module take a Decimal x and the number of
+# significant digits <prec> of the result. They calculate with a few guard
+# digits and round the result to <prec> digits. exp, ln, log10, sqrt and
+# pow use the (correctly rounded) Decimal methods, the trigonometric
+# functions are computed from Taylor series after argument reduction.
+
+from collections import OrderedDict
+from decimal import Decimal, getcontext, localcontext
+from decimal import InvalidOperation, Overflow
+
+import logging
+_logger = logging.getLogger('DecMath')
+
+GUARD_DIGITS = 10
+
+# Constants by (name, precision), the least recently used are dropped
+_constants = OrderedDict()
+_CONSTANTS_CACHE_SIZE = 32
+
+
+def _domain_error():
+    return ValueError('math domain error')
+
+
+def _rounded(func):
+    '''
+    Make func(x), calculating with the precision of the current context,
+    into func(x, prec) calculating with guard digits. Decimal errors are
+    raised as the errors of the float functions in math.
+    '''
+
+    def wrapper(x, prec):
+        with localcontext() as ctx:
+            ctx.prec = prec + GUARD_DIGITS
+            try:
+                ret = func(x)
+            except Overflow:
+                raise OverflowError('math range error')
+            except InvalidOperation:
+                raise _domain_error()
+            ctx.prec = prec
+            return +ret
+
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def _cached_constant(name, prec, func):
+    '''Return constant <name> with <prec> digits, computed by func(prec).'''
+    key = (name, prec)
+    ret = _constants.get(key)
+    if ret is None:
+        with localcontext() as ctx:
+            ctx.prec = prec + GUARD_DIGITS
+            ret = func(ctx.prec)
+            ctx.prec = prec
+            ret = +ret
+        _constants[key] = ret
+        if len(_constants) > _CONSTANTS_CACHE_SIZE:
+            _constants.popitem(last=False)
+    else:
+        _constants.move_to_end(key)
+    return ret
+
+
+def _chudnovsky_pi(prec):
+    '''Compute pi with the Chudnovsky series, summed by binary splitting.'''
+
+    c3_24 = 640320 ** 3 // 24
+
+    def split(a, b):
+        if b - a == 1:
+            if a == 0:
+                p = q = 1
+            else:
+                p = (6 * a - 5) * (2 * a - 1) * (6 * a - 1)
+                q = a * a * a * c3_24
+            t = p * (13591409 + 545140134 * a)
+            if a & 1:
+                t = -t
+            return p, q, t
+        m = (a + b) // 2
+        p1, q1, t1 = split(a, m)
+        p2, q2, t2 = split(m, b)
+        return p1 * p2, q1 * q2, q2 * t1 + p1 * t2
+
+    # Every term adds a little over 14 digits
+    p, q, t = split(0, prec // 14 + 2)
+    return Decimal(426880) * Decimal(10005).sqrt() * q / t
+
+
+def pi(prec):
+    return _cached_constant('pi', prec, _chudnovsky_pi)
+
+
+def e(prec):
+    return _cached_constant('e', prec, lambda prec: Decimal(1).exp())
+
+
+def ln2(prec):
+    return _cached_constant('ln2', prec, lambda prec: Decimal(2).ln())
+
+
+def golden_ratio(prec):
+    return _cached_constant('golden_ratio', prec,
+                            lambda prec: (1 + Decimal(5).sqrt()) / 2)
+
+
+@_rounded
+def sqrt(x):
+    if x < 0:
+        raise _domain_error()
+    return x.sqrt()
+
+
+@_rounded
+def exp(x):
+    return x.exp()
+
+
+@_rounded
+def ln(x):
+    if x <= 0:
+        raise _domain_error()
+    return x.ln()
+
+
+@_rounded
+def log10(x):
+    if x <= 0:
+        raise _domain_error()
+    return x.log10()
+
+
+def pow(x, y, prec):
+    '''Return x ** y for a non-integer y.'''
+    if x < 0:
+        raise _domain_error()
+    with localcontext() as ctx:
+        ctx.prec = prec + GUARD_DIGITS
+        try:
+            ret = x ** y
+        except Overflow:
+            raise OverflowError('math range error')
+        ctx.prec = prec
+        return +ret
+
+
+def _sin_series(x):
+    x2 = x * x
+    ret = term = x
+    n = 1
+    while True:
+        term = -term * x2 / ((n + 1) * (n + 2))
+        n += 2
+        new = ret + term
+        if new == ret:
+            return ret
+        ret = new
+
+
+def _cos_series(x):
+    x2 = x * x
+    ret = term = Decimal(1)
+    n = 0
+    while True:
+        term = -term * x2 / ((n + 1) * (n + 2))
+        n += 2
+        new = ret + term
+        if new == ret:
+            return ret
+        ret = new
+
+
+def _reduce_angle(x):
+    '''
+    Return (k, r) with x = k * pi / 2 + r, |r| <= pi / 4 and k in 0..3.
+    The reduction loses as many digits as x has before the point, so it
+    uses that many extra digits.
+    '''
+
+    with localcontext() as ctx:
+        ctx.prec += max(x.adjusted(), 0)
+        half_pi = pi(ctx.prec) / 2
+        k = (x / half_pi).to_integral_value()
+        r = x - k * half_pi
+    return int(k) % 4, +r
+
+
+@_rounded
+def sin(x):
+    if x == 0:
+        return x
+    k, r = _reduce_angle(x)
+    if k % 2 == 0:
+        ret = _sin_series(r)
+    else:
+        ret = _cos_series(r)
+    return -ret if k >= 2 else ret
+
+
+@_rounded
+def cos(x):
+    k, r = _reduce_angle(x)
+    if k % 2 == 0:
+        ret = _cos_series(r)
+    else:
+        ret = _sin_series(r)
+    return -ret if k in (1, 2) else ret
+
+
+@_rounded
+def tan(x):
+    if x == 0:
+        return x
+    k, r = _reduce_angle(x)
+    s = _sin_series(r)
+    c = _cos_series(r)
+    if k % 2 == 1:
+        s, c = -c, s
+    if c == 0:
+        raise _domain_error()
+    return s / c
+
+
+def _half_pi():
+    return pi(getcontext().prec) / 2
+
+
+def _atan(x):
+    if x < 0:
+        return -_atan(-x)
+    if x > 1:
+        return _half_pi() - _atan(1 / x)
+
+    # Halve the angle until the series converges quickly:
+    # atan(x) = 2 * atan(x / (1 + sqrt(1 + x^2)))
+    doublings = 0
+    while x > Decimal('0.1'):
+        x = x / (1 + (1 + x * x).sqrt())
+        doublings += 1
+
+    x2 = x * x
+    ret = term = x
+    n = 1
+    while True:
+        term = -term * x2
+        n += 2
+        new = ret + term / n
+        if new == ret:
+            break
+        ret = new
+    return ret * 2 ** doublings
+
+
+@_rounded
+def atan(x):
+    return _atan(x)
+
+
+@_rounded
+def asin(x):
+    if abs(x) > 1:
+        raise _domain_error()
+    if abs(x) == 1:
+        return _half_pi().copy_sign(x)
+    return _atan(x / (1 - x * x).sqrt())
+
+
+@_rounded
+def acos(x):
+    if abs(x) > 1:
+        raise _domain_error()
+    if abs(x) == 1:
+        return _half_pi() - _half_pi().copy_sign(x)
+    return _half_pi() - _atan(x / (1 - x * x).sqrt())
+
+
+def _extra_digits(x):
+    '''Digits lost by cancellation in exp(x) - exp(-x) for small x.'''
+    return max(-x.adjusted(), 0)
+
+
+@_rounded
+def sinh(x):
+    with localcontext() as ctx:
+        ctx.prec += _extra_digits(x)
+        ex = x.exp()
+        return (ex - 1 / ex) / 2
+
+
+@_rounded
+def cosh(x):
+    ex = x.exp()
+    return (ex + 1 / ex) / 2
+
+
+@_rounded
+def tanh(x):
+    with localcontext() as ctx:
+        ctx.prec += _extra_digits(x)
+        e2x = (2 * x).exp()
+        return (e2x - 1) / (e2x + 1)
+
+
+@_rounded
+def asinh(x):
+    if x < 0:
+        return -asinh(-x, getcontext().prec)
+    with localcontext() as ctx:
+        ctx.prec += _extra_digits(x)
+        return (x + (x * x + 1).sqrt()).ln()
+
+
+@_rounded
+def acosh(x):
+    if x < 1:
+        raise _domain_error()
+    return (x + (x * x - 1).sqrt()).ln()
+
+
+@_rounded
+def atanh(x):
+    if abs(x) >= 1:
+        raise _domain_error()
+    with localcontext() as ctx:
+        ctx.prec += _extra_digits(x)
+        return ((1 + x) / (1 - x)).ln() / 2
+
+
+if __name__ == '__main__':
+    # Compare the speed and accuracy with the float functions in math,
+    # at the precision of floats and with more digits.
+    import math
+    import timeit
+
+    args = [Decimal(i) / 7 for i in range(1, 8)]
+    for name in ('sqrt', 'exp', 'ln', 'sin', 'cos', 'tan', 'atan', 'asin',
+                 'sinh', 'tanh'):
+        dfunc = globals()[name]
+        ffunc = getattr(math, 'log' if name == 'ln' else name)
+        fargs = [float(a) for a in args if name != 'asin' or a < 1]
+        dargs = [a for a in args if name != 'asin' or a < 1]
+        tf = min(timeit.repeat(lambda: [ffunc(a) for a in fargs],
+                               number=100, repeat=3)) / 100 / len(fargs)
+        line = '%-5s float: %6.3f us' % (name, tf * 1e6)
+        for prec in (16, 50, 200):
+            td = min(timeit.repeat(lambda: [dfunc(a, prec) for a in dargs],
+                                   number=10, repeat=3)) / 10 / len(dargs)
+            line += ', %d digits: %8.1f us' % (prec, td * 1e6)
+        err = max(abs(float(dfunc(a, 50)) - ffunc(float(a))) for a in dargs)
+        print(line + ', max float error %.1e' % err)
+
+    for prec in (50, 1000, 10000):
+        _constants.clear()
+        t = min(timeit.repeat(lambda: _chudnovsky_pi(prec), number=1,
+                              repeat=3))
+        print('pi with %d digits: %.2f ms' % (prec, t * 1000))
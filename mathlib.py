@@ -20,15 +20,61 @@
 #    2007-07-03: rwh, first version
 
 import math
-from decimal import Decimal
+from collections import OrderedDict
+from decimal import Context, Decimal, getcontext, localcontext
+from decimal import Inexact, MAX_EMAX, MIN_EMIN, MAX_PREC
 from rational import Rational
 
 import logging
 _logger = logging.getLogger('MathLib')
 
+_LOG10_2 = math.log10(2)
+
+# Context to normalize Decimals without rounding them
+_EXACT_CONTEXT = Context(prec=MAX_PREC, Emax=MAX_EMAX, Emin=MIN_EMIN)
+
 from gettext import gettext as _
 import locale
 
+# Integers with more bits are converted to Decimals by _int_to_decimal()
+_INT_SPLIT_BITS = 1024
+
+
+def _int_to_decimal(n):
+    '''
+    Convert integer <n> to a Decimal exactly. Decimal(n) takes quadratic
+    time, 20 s for a million digits; splitting n in halves recursively and
+    combining them with Decimal multiplications takes well under a second.
+    '''
+
+    powers = {}
+
+    def pow2(bits):
+        ret = powers.get(bits)
+        if ret is None:
+            if bits <= _INT_SPLIT_BITS:
+                ret = Decimal(2) ** bits
+            else:
+                half = bits >> 1
+                ret = pow2(half) * pow2(bits - half)
+            powers[bits] = ret
+        return ret
+
+    def convert(n, bits):
+        if bits <= _INT_SPLIT_BITS:
+            return Decimal(n)
+        half = bits >> 1
+        hi = n >> half
+        lo = n - (hi << half)
+        return convert(lo, half) + convert(hi, bits - half) * pow2(half)
+
+    with localcontext() as ctx:
+        ctx.prec = MAX_PREC
+        ctx.Emax = MAX_EMAX
+        ctx.traps[Inexact] = True
+        ret = convert(abs(n), abs(n).bit_length())
+        return -ret if n < 0 else ret
+
 
 class MathLib:
     ANGLE_DEG = math.pi / 180
@@ -38,12 +84,25 @@ class MathLib:
     FORMAT_EXPONENT = 1
     FORMAT_SCIENTIFIC = 2
 
+    # Number of formatted results to remember, about one history
+    FORMAT_CACHE_SIZE = 512
+
+    # Integers with more digits are shown like other numbers, with
+    # digit_limit digits and an exponent, unless all digits are asked for
+    INT_DIGIT_LIMIT = 100
+
     def __init__(self):
+        self._format_cache = OrderedDict()
         self.set_format_type(self.FORMAT_SCIENTIFIC)
         self.set_digit_limit(9)
         self.set_chop_zeros(True)
         self.set_integer_base(10)
 
+        # Allow huge results such as an approximated factorial(10**7)
+        ctx = getcontext()
+        ctx.Emax = MAX_EMAX
+        ctx.Emin = MIN_EMIN
+
         self._setup_i18n()
 
     def _setup_i18n(self):
@@ -97,13 +156,17 @@ class MathLib:
         if isinstance(val, Decimal):
             return val
         elif type(val) in (int, int):
+            if val.bit_length() > _INT_SPLIT_BITS:
+                return _int_to_decimal(val)
             return Decimal(val)
         elif isinstance(val, str):
             d = Decimal(val)
             return d.normalize()
+        elif isinstance(val, Rational):
+            return val._decimal()
         elif isinstance(val, float) or hasattr(val, '__float__'):
-            s = '%.18e' % float(val)
-            d = Decimal(s)
+            # The shortest string that gives the same float
+            d = Decimal(repr(float(val)))
             return d.normalize()
         else:
             return None
@@ -132,67 +195,97 @@ class MathLib:
         ret = self._BASE_FUNC_MAP[base](int(n))
         return ret.rstrip('L')
 
-    def format_decimal(self, n):
-        a = int(n)
-        if a == n:
+    def is_big_int(self, n):
+        '''
+        Return whether <n> is an integer, or an integral Decimal, with more
+        than INT_DIGIT_LIMIT digits, which is shown with an exponent.
+        '''
+        if isinstance(n, int):
+            return abs(n) >= 10 ** self.INT_DIGIT_LIMIT
+        elif isinstance(n, Decimal) and n.is_finite():
+            return n.adjusted() >= self.INT_DIGIT_LIMIT and \
+                n == n.to_integral_value()
+        return False
+
+    def format_decimal(self, n, full=False):
+        # Integers are shown as they are, unless they have more than
+        # INT_DIGIT_LIMIT digits. Compare without int(n), which is slow for
+        # huge exponents.
+        if n == n.to_integral_value() and \
+                (full or n.adjusted() < self.INT_DIGIT_LIMIT):
+            # Without an exponent, e.g. for 0E-29 computed in precision mode
+            if not n:
+                return '0'
+            elif n.adjusted() < self.INT_DIGIT_LIMIT:
+                return format(n.to_integral_value(), 'f')
             return str(n)
         if self.chop_zeros:
-            n = n.normalize()
-        (sign, digits, exp) = n.as_tuple()
-        if len(digits) > self.digit_limit:
-            exp += len(digits) - self.digit_limit
-            digits = digits[:self.digit_limit]
-        if len(digits) < self.digit_limit:
-            exp -= self.digit_limit - len(digits)
-            digits += (0,) * (self.digit_limit - len(digits))
-            print(exp, digits)
-        if sign:
-            res = "-"
-        else:
-            res = ""
-        int_len = len(digits) + exp
-
-        if int_len == 0:
-            if exp < -self.digit_limit:
-                disp_exp = exp + len(digits)
-            else:
-                disp_exp = 0
-        elif -self.digit_limit < int_len < self.digit_limit:
-            disp_exp = 0
-        else:
-            disp_exp = int_len - 1
-
-        dot_pos = int_len - disp_exp
-
-# _logger.debug('len(digits) %d, exp: %d, int_len: %d, disp_exp: %d,
-# dot_pos: %d', len(digits), exp, int_len, disp_exp, dot_pos)
-
-        if dot_pos < 0:
-            res += '0' + self.fraction_sep
-            for i in range(dot_pos, 0):
-                res += '0'
-
-        for i in range(len(digits)):
-            if i == dot_pos:
-                if i == 0:
-                    res += '0' + self.fraction_sep
-                else:
-                    res += self.fraction_sep
-            res += str(digits[i])
-
-        if int_len > 0 and len(digits) < dot_pos:
-            for i in range(len(digits), dot_pos):
-                res += '0'
-
+            # normalize() rounds to the precision of the context
+            n = n.normalize(_EXACT_CONTEXT)
+
+        # Position of the decimal point relative to the first digit
+        int_len = n.adjusted() + 1
+
+        # All digits, from e.g. '-1.2340e+1'
+        mantissa = format(n, 'e').partition('e')[0]
+        if n.is_signed():
+            mantissa = mantissa[1:]
+        return self._format_digits(n.is_signed(), mantissa.replace('.', ''),
+                                   int_len)
+
+    def _format_digits(self, sign, digits, int_len):
+        '''
+        Format the number with the digits in string <digits>, the decimal
+        point <int_len> digits after the first digit, and a minus sign if
+        <sign> is True.
+        '''
+
+        # Show exactly digit_limit digits, cut off or padded with zeros
+        limit = self.digit_limit
+        digits = digits[:limit].ljust(limit, '0')
+
+        res = '-' if sign else ''
+        if -limit < int_len <= 0:
+            return res + '0' + self.fraction_sep + '0' * -int_len + digits
+        elif 0 < int_len < limit:
+            return res + digits[:int_len] + self.fraction_sep + \
+                digits[int_len:]
+
+        res += digits[0]
+        if limit > 1:
+            res += self.fraction_sep + digits[1:]
+        disp_exp = int_len - 1
         if disp_exp != 0:
             if self.format_type == self.FORMAT_EXPONENT:
-                res = res + 'e%d' % disp_exp
+                res += 'e%d' % disp_exp
             elif self.format_type == self.FORMAT_SCIENTIFIC:
-                res = res + '×10**%d' % disp_exp
-
+                res += '×10**%d' % disp_exp
         return res
 
-    def format_number(self, n):
+    def _format_big_int(self, n):
+        '''
+        Format an integer with more than INT_DIGIT_LIMIT digits, computing
+        only its leading digits.
+        '''
+
+        sign = n < 0
+        n = -n if sign else n
+
+        # n has k or k + 1 digits. Dividing by 10 ** shift leaves one or two
+        # more digits than shown, cut off exactly like format_decimal does.
+        # The quotient is small, so this takes time linear in the size of n.
+        k = int((n.bit_length() - 1) * _LOG10_2) + 1
+        shift = max(k - self.digit_limit - 1, 0)
+        lead = str((n >> shift) // 5 ** shift)
+        return self._format_digits(sign, lead, len(lead) + shift)
+
+    def format_number(self, n, full=False):
+        '''
+        Format a number for display. Integers with more than INT_DIGIT_LIMIT
+        digits are shown with an exponent, unless <full> is True, which
+        gives the exact value to insert into an equation.
+        '''
+
         if isinstance(n, bool):
             if n:
                 return 'True'
@@ -200,25 +293,95 @@ class MathLib:
                 return 'False'
         elif isinstance(n, str):
             return n
-        elif isinstance(n, str):
-            return n
-        elif isinstance(n, str):
-            return _('Undefined')
-        elif isinstance(n, int):
-            n = self.d(n)
-        elif isinstance(n, float):
-            n = self.d(n)
-        elif isinstance(n, int):
+
+        # Equal Decimals such as 2 and 2.0 are shown differently
+        if isinstance(n, Decimal):
+            value = str(n)
+        else:
+            value = n
+        key = (type(n), value) + self._format_settings(full)
+        try:
+            ret = self._format_cache.get(key)
+        except TypeError:
+            key = ret = None
+        if ret is not None:
+            self._format_cache.move_to_end(key)
+            return ret
+
+        ret = self._format_value(n, full)
+        if ret is None:
+            return _('Error: unsupported type')
+
+        if key is not None:
+            self._format_cache[key] = ret
+            if len(self._format_cache) > self.FORMAT_CACHE_SIZE:
+                self._format_cache.popitem(last=False)
+        return ret
+
+    def format_many(self, values):
+        '''
+        Format a list of values like format_number(), e.g. a whole history.
+        The settings are looked up once, and numbers are formatted without
+        going through all type checks of format_number().
+        '''
+
+        settings = self._format_settings(False)
+        cache = self._format_cache
+        ret = []
+        for n in values:
+            cls = type(n)
+            if cls is Decimal:
+                key = (cls, str(n)) + settings
+            elif cls in (int, float, Rational):
+                key = (cls, n) + settings
+            else:
+                ret.append(self.format_number(n))
+                continue
+
+            s = cache.get(key)
+            if s is None:
+                s = self._format_value(n, False)
+                cache[key] = s
+            else:
+                cache.move_to_end(key)
+            ret.append(s)
+
+        while len(cache) > self.FORMAT_CACHE_SIZE:
+            cache.popitem(last=False)
+        return ret
+
+    def _format_settings(self, full):
+        '''Return the settings that format_number() results depend on.'''
+        return (self.digit_limit, self.format_type, self.integer_base,
+                self.chop_zeros, full)
+
+    def _format_value(self, n, full):
+        '''
+        Format a number, or return None if it has an unsupported type.
+        Values with a true 'approximate' attribute, such as factorials too
+        large to compute exactly, are marked with '≈'.
+        '''
+
+        approximate = getattr(n, 'approximate', False)
+
+        if isinstance(n, int) and not full and self.integer_base == 10 and \
+                self.is_big_int(n):
+            return self._format_big_int(n)
+
+        if isinstance(n, (int, float)):
             n = self.d(n)
         elif isinstance(n, Rational):
             n = self.d(Decimal(n.n) / Decimal(n.d))
         elif not isinstance(n, Decimal):
-            return _('Error: unsupported type')
+            return None
 
-        if self.is_int(n) and self.integer_base != 10:
+        if self.integer_base != 10 and self.is_int(n):
             return self.format_int(n)
-        else:
-            return self.format_decimal(n)
+
+        ret = self.format_decimal(n, full)
+        if approximate and not full:
+            ret = '≈' + ret
+        return ret
 
     def short_format(self, n):
         ret = self.format_number(n)
@@ -255,3 +418,29 @@ if __name__ == "__main__":
               (ml.format_number(val), valstr))
     for base in (2, 8, 16):
         print('Format 252 in base %d: %s' % (base, ml.format_int(252, base)))
+
+    # Benchmark formatting a history worth of results, without and with
+    # the results in the cache
+    import random
+    import timeit
+    random.seed(0)
+    corpus = [Decimal(random.randint(1, 10 ** 20)).scaleb(
+        random.randint(-30, 10)) for i in range(500)]
+    ml.set_digit_limit(9)
+
+    def format_all():
+        for val in corpus:
+            ml.format_number(val)
+
+    def format_all_uncached():
+        ml._format_cache.clear()
+        format_all()
+
+    def format_many_uncached():
+        ml._format_cache.clear()
+        ml.format_many(corpus)
+
+    for func in (format_all_uncached, format_all, format_many_uncached):
+        t = min(timeit.repeat(func, number=10, repeat=3)) / 10
+        print('%s: %.2f ms for %d values' % (func.__name__, t * 1000,
+                                             len(corpus)))
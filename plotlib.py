@@ -18,17 +18,93 @@
 # Change log:
 #    2007-09-04: rwh, first version
 
-from io import StringIO
+from collections import OrderedDict
+from io import BytesIO, StringIO
+import ast
+import time
 import logging
 _logger = logging.getLogger('PlotLib')
 
-USE_MPL = True
+# Plotting back-end: 'auto' uses matplotlib if it is available and the
+# custom back-end otherwise, 'matplotlib' and 'custom' force one of them.
+# The back-end is only loaded when the first plot is made.
+BACKENDS = ('auto', 'matplotlib', 'custom')
+BACKEND = 'auto'
 
 
 def format_float(x):
     return ('%.2f' % x).rstrip('0').rstrip('.')
 
 
+class PlotCache:
+
+    """
+    Least recently used cache of plots, limited by the (estimated) number
+    of bytes of the cached values. Keys added since the last pop_added()
+    are tracked, so that plots made in a worker process can be copied back.
+    """
+
+    MAX_BYTES = 16 * 1024 * 1024
+
+    # Approximate size of an (x, y) tuple of floats
+    POINT_SIZE = 104
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._added = set()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Return the value stored for <key>, or None."""
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, size):
+        """Store <value> of <size> bytes for <key>."""
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        if size > self.max_bytes:
+            self._added.discard(key)
+            return
+
+        self._items[key] = (value, size)
+        self._added.add(key)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            key, (value, size) = self._items.popitem(last=False)
+            self._added.discard(key)
+            self.nbytes -= size
+
+    def clear(self):
+        self._items.clear()
+        self._added.clear()
+        self.nbytes = 0
+
+    def pop_added(self):
+        """Return the (key, value, size) items added since the last call."""
+        ret = [(key,) + self._items[key] for key in self._added]
+        self._added.clear()
+        return ret
+
+    def update(self, items):
+        """Store items returned by pop_added()."""
+        for key, value, size in items:
+            self.put(key, value, size)
+        self._added.clear()
+
+
 class _PlotBase:
 
     """Class to generate an svg plot for a function.
@@ -37,6 +113,8 @@ class _PlotBase:
     def __init__(self, parser):
         self.svg_data = ""
         self.parser = parser
+        self.cache = PlotCache()
+        self._last_plot = None
 
     def get_svg(self):
         return self.svg_data
@@ -44,43 +122,314 @@ class _PlotBase:
     def set_svg(self, data):
         self.svg_data = data
 
+    # Adaptive sampling: start with a coarse grid and keep halving the
+    # segments where the curve bends (MAX_BEND) or rises steeply (MAX_RISE),
+    # relative to the height of the plot, until <points> are used.
+    # Segments that are still steep at MIN_WIDTH (relative to the range)
+    # are considered discontinuities and the curve is broken there.
+    MAX_BEND = 0.002
+    MAX_RISE = 0.05
+    MIN_WIDTH = 1e-5
+
     def evaluate(self, eqn, var, range, points=100):
+        """
+        Sample <eqn> for <var> in <range>, using at most <points>
+        evaluations. Returns a list of (x, y) pairs; y is NaN where the
+        equation could not be evaluated and where the curve should be
+        broken, for example at poles.
+        """
+
+        return self.evaluate_curves(eqn, var, range, points)[0]
+
+    def evaluate_curves(self, eqn, var, range, points=100, parametric=False):
+        """
+        Sample <eqn>, which may be a tuple of equations, for <var> in
+        <range> like evaluate(), evaluating all equations in one pass.
+        Returns a list with a list of (x, y) pairs for every equation. If
+        <parametric> is True, <eqn> should be a pair (x(var), y(var)),
+        giving a single curve.
+        """
+
         x_old = self.parser.get_var(var)
 
         if type(eqn) in (bytes, str):
             eqn = self.parser.parse(eqn)
 
-        res = []
-        d = float((range[1] - range[0])) / (points - 1)
-        x = range[0]
-        while points > 0:
+        n = self._count_equations(eqn)
+        if parametric and n != 2:
+            raise ValueError('A parametric plot needs two equations')
+
+        try:
+            xs, yss = self._sample(eqn, n, var, float(range[0]),
+                                   float(range[1]), max(points, 2))
+        finally:
+            self.parser.set_var(var, x_old)
+
+        min_width = abs(xs[-1] - xs[0]) * self.MIN_WIDTH
+        if parametric:
+            # Break the curve where either coordinate jumps
+            breaks = self._find_breaks(xs, yss[0], min_width) | \
+                self._find_breaks(xs, yss[1], min_width)
+            return [self._break_curve(yss[0], yss[1], breaks)]
+
+        return [self._break_curve(xs, ys, self._find_breaks(xs, ys, min_width))
+                for ys in yss]
+
+    def _count_equations(self, tree):
+        """Return the number of equations in <tree>, a tuple gives several."""
+
+        if isinstance(tree, ast.Expression):
+            tree = tree.body
+        elif isinstance(tree, ast.Expr):
+            tree = tree.value
+        if isinstance(tree, ast.Tuple):
+            return len(tree.elts)
+        return 1
+
+    def _sample(self, eqn, n, var, x0, x1, points):
+        """
+        Adaptively sample the <n> equations in <eqn>. Returns the sample
+        points and, for each equation, the values at those points.
+        """
+
+        m = min(points, max(points // 4, 16))
+        d = (x1 - x0) / (m - 1)
+        xs = [x0 + i * d for i in range(m)]
+        xs[-1] = x1
+        yss = self._evaluate_points(eqn, n, var, xs)
+        if all([y != y for ys in yss for y in ys]):
+            # Nothing could be evaluated, show the error of the first point
+            self.parser.set_var(var, x0)
+            self.parser.evaluate(eqn)
+
+        # A range of zero width has nothing to refine
+        if x1 == x0:
+            return xs, yss
+
+        budget = points - m
+        min_width = abs(x1 - x0) * self.MIN_WIDTH
+        while budget > 0:
+            errs = [max(e) for e in
+                    zip(*[self._segment_errors(xs, ys, min_width)
+                          for ys in yss])]
+            refine = sorted([i for i, err in enumerate(errs) if err > 1],
+                            key=lambda i: -errs[i])[:budget]
+            if len(refine) == 0:
+                break
+            refine.sort()
+            new_xs = [(xs[i] + xs[i + 1]) / 2 for i in refine]
+            new_yss = self._evaluate_points(eqn, n, var, new_xs)
+            budget -= len(new_xs)
+
+            xs = self._merge_samples(xs, refine, new_xs)
+            yss = [self._merge_samples(ys, refine, new_ys)
+                   for ys, new_ys in zip(yss, new_yss)]
+
+        return xs, yss
+
+    def _merge_samples(self, vals, refine, new_vals):
+        """Insert <new_vals> after the indices in (sorted) <refine>."""
+
+        ret = []
+        prev = 0
+        for i, val in zip(refine, new_vals):
+            ret.extend(vals[prev:i + 1])
+            ret.append(val)
+            prev = i + 1
+        ret.extend(vals[prev:])
+        return ret
+
+    def _evaluate_points(self, eqn, n, var, xs):
+        """
+        Evaluate the <n> equations in <eqn> for all values in <xs>. Returns
+        a list of values for each equation, NaN where it fails.
+        """
+
+        yss = None
+        if self.parser.get_numpy() is not None:
+            yss = self._evaluate_vector(eqn, n, var, xs)
+        if yss is None:
+            yss = self._evaluate_scalar(eqn, n, var, xs)
+        nan = float('nan')
+        inf = float('inf')
+        return [[y if abs(y) != inf else nan for y in ys] for ys in yss]
+
+    def _evaluate_vector(self, eqn, n, var, xs):
+        '''
+        Evaluate <eqn> for all points at once, with <var> bound to an array.
+        Returns None if the equation can not be evaluated element-wise.
+        '''
+
+        np = self.parser.get_numpy()
+        x = np.array(xs, dtype=float)
+        self.parser.set_var(var, x)
+        try:
+            ret = self.parser.evaluate(eqn, vector=True)
+            if ret is None:
+                return None
+            if n == 1:
+                ret = (ret,)
+            yss = [np.broadcast_to(np.asarray(y, dtype=float), x.shape)
+                   for y in ret]
+        except Exception as e:
+            _logger.debug('Falling back to scalar evaluation: %s', e)
+            return None
+
+        return [y.tolist() for y in yss]
+
+    def _evaluate_scalar(self, eqn, n, var, xs):
+        from astparser import LimitError
+
+        yss = [[] for i in range(n)]
+        for x in xs:
             self.parser.set_var(var, x)
-            ret = self.parser.evaluate(eqn)
-            if ret is not None:
-                v = float(ret)
+            try:
+                ret = self.parser.evaluate(eqn)
+                if n == 1:
+                    ret = (ret,)
+                vals = [float(v) if v is not None else 0 for v in ret]
+            except LimitError:
+                raise
+            except Exception as e:
+                _logger.debug('Can not evaluate at %r: %s', x, e)
+                vals = [float('nan')] * n
+            for ys, v in zip(yss, vals):
+                ys.append(v)
+
+        return yss
+
+    def _y_scale(self, ys):
+        """Height of the bulk of the curve, ignoring values near poles."""
+
+        finite = sorted([y for y in ys if y == y])
+        if len(finite) < 2:
+            return 1.0
+        k = len(finite) // 50
+        scale = finite[-1 - k] - finite[k]
+        if scale <= 0:
+            scale = max(abs(finite[k]), 1.0)
+        return scale
+
+    def _segment_errors(self, xs, ys, min_width):
+        """
+        Return for each segment how much it needs refinement; values above
+        1 mean it should be split.
+        """
+
+        scale = self._y_scale(ys)
+        width = xs[-1] - xs[0]
+        n = len(xs)
+
+        rise = []
+        for i in range(n - 1):
+            dx = xs[i + 1] - xs[i]
+            y0, y1 = ys[i], ys[i + 1]
+            nan0 = y0 != y0
+            nan1 = y1 != y1
+            if abs(dx) <= min_width or (nan0 and nan1):
+                rise.append(0)
+            elif nan0 or nan1:
+                # Locate the edge of the domain
+                rise.append(2 * abs(dx) / width / self.MIN_WIDTH ** 0.5)
+            else:
+                rise.append(abs(y1 - y0) / scale / self.MAX_RISE)
+
+        # Deviation of each point from the line through its neighbours.
+        # Skip points next to a steep segment: splitting that one is enough.
+        bend = [0.0] * n
+        for i in range(1, n - 1):
+            y0, y1, y2 = ys[i - 1], ys[i], ys[i + 1]
+            if y0 != y0 or y1 != y1 or y2 != y2 or \
+                    rise[i - 1] > 1 or rise[i] > 1:
+                continue
+            t = (xs[i] - xs[i - 1]) / (xs[i + 1] - xs[i - 1])
+            bend[i] = abs(y1 - (y0 + t * (y2 - y0))) / scale / self.MAX_BEND
+
+        errs = []
+        for i in range(n - 1):
+            if abs(xs[i + 1] - xs[i]) <= min_width:
+                errs.append(0)
             else:
-                v = 0
-            res.append((x, v))
-            x += d
-            points -= 1
+                errs.append(max(rise[i], bend[i], bend[i + 1]))
+        return errs
+
+    def _find_breaks(self, xs, ys, min_width):
+        """
+        Return the indices i where the curve should be broken between
+        point i - 1 and i: steep segments that could not be resolved
+        further and sign changes between large values (poles).
+        """
+
+        scale = self._y_scale(ys)
+        ret = set()
+        for i in range(1, len(xs)):
+            y0, y1 = ys[i - 1], ys[i]
+            jump = abs(xs[i] - xs[i - 1]) <= 2 * min_width and \
+                abs(y1 - y0) / scale > self.MAX_RISE
+            pole = y0 * y1 < 0 and min(abs(y0), abs(y1)) > scale
+            if jump or pole:
+                ret.add(i)
+        return ret
+
+    def _break_curve(self, xs, ys, breaks):
+        """Return the (x, y) pairs, with a NaN pair inserted at <breaks>."""
 
-        self.parser.set_var(var, x_old)
+        nan = float('nan')
+        res = [(xs[0], ys[0])]
+        for i in range(1, len(xs)):
+            if i in breaks:
+                res.append((nan, nan))
+            res.append((xs[i], ys[i]))
         return res
 
     def export_plot(self, fn):
-        f = open(fn, "w")
-        f.write(self.get_svg())
+        svg = self.get_svg()
+        f = open(fn, "wb" if isinstance(svg, bytes) else "w")
+        f.write(svg)
         f.close()
 
-    def produce_plot(self, vals, *args, **kwargs):
-        '''Function to produce the actual plot, override.'''
+    def produce_plot(self, curves, *args, **kwargs):
+        '''
+        Function to produce the actual plot of <curves>, a list with a list
+        of (x, y) pairs for every curve, override.
+        '''
         pass
 
+    def get_backend_name(self):
+        '''Return the name of the class producing the plots.'''
+        return type(self).__name__
+
+    def _cache_key(self, tree, var, range, points, parametric):
+        """
+        Return the key to cache the plot of <tree> under, or None if it
+        can not be cached. The key contains the versions of all variables
+        the equation depends on, so changing one of them gives a new key.
+        """
+
+        versions = []
+        for name in sorted(self.parser.get_tree_vars(tree)):
+            if name == var:
+                continue
+            if self.parser.is_volatile(name):
+                return None
+            versions.append((name, self.parser.get_var_version(name)))
+
+        scaling = self.parser.get_var('angle_scaling')
+        try:
+            r = (float(range[0]), float(range[1]))
+        except (TypeError, ValueError):
+            return None
+        return (ast.dump(tree), var, r, points, parametric, tuple(versions),
+                getattr(scaling, 'value', None))
+
     def plot(self, eqn, **kwargs):
         '''
-        Plot function <eqn>.
+        Plot function <eqn>. A tuple of equations gives several curves in
+        one plot, e.g. plot((sin(x), cos(x)), x=0..pi).
 
-        kwargs can contain: 'points'
+        kwargs can contain: 'points', the maximum number of evaluations
+        and 'parametric': if True, <eqn> is a pair (x(t), y(t)), e.g.
+        plot((cos(t), sin(t)), t=0..2*pi, parametric=True).
 
         The last item in kwargs is interpreted as the variable that should
         be varied.
@@ -93,6 +442,7 @@ class _PlotBase:
             return None
 
         points = kwargs.pop('points', 100)
+        parametric = bool(kwargs.pop('parametric', False))
         if len(kwargs) > 1:
             _logger.error('Too many variables specified')
             return None
@@ -100,9 +450,42 @@ class _PlotBase:
         for var, range in kwargs.items():
             _logger.info('Plot range for var %s: %r', var, range)
 
-        vals = self.evaluate(eqn, var, range, points=points)
-        _logger.debug('vals are %r', vals)
-        svg = self.produce_plot(vals, xlabel=var, ylabel='f(x)')
+        if type(eqn) in (bytes, str):
+            eqn = self.parser.parse(eqn)
+
+        n = self._count_equations(eqn)
+        if parametric and n != 2:
+            _logger.error('Parametric plot needs two equations')
+            return None
+
+        key = self._cache_key(eqn, var, range, points, parametric)
+        backend = self.get_backend_name()
+        item = None
+        if key is not None:
+            item = self.cache.get(key)
+        if item is None:
+            curves = self.evaluate_curves(eqn, var, range, points=points,
+                                          parametric=parametric)
+            svgs = {}
+        else:
+            curves, svgs = item
+        _logger.debug('curves are %r', curves)
+
+        if parametric:
+            labels = dict(xlabel='x(%s)' % var, ylabel='y(%s)' % var)
+        else:
+            labels = dict(xlabel=var, ylabel='f(%s)' % var)
+        self._last_plot = (curves, labels)
+        svg = svgs.get(backend)
+        if svg is None:
+            svg = self.produce_plot(curves, **labels)
+            if key is not None:
+                svgs = dict(svgs)
+                svgs[backend] = svg
+                npoints = sum([len(vals) for vals in curves])
+                size = npoints * self.cache.POINT_SIZE + \
+                    sum([len(s) for s in svgs.values()])
+                self.cache.put(key, (curves, svgs), size)
         _logger.debug('SVG Data: %s', svg)
         self.set_svg(svg)
 
@@ -115,59 +498,76 @@ class _PlotBase:
 
 class CustomPlot(_PlotBase):
 
+    COLORS = ('blue', 'red', 'green', 'orange', 'purple', 'brown')
+
     def __init__(self, parser):
         _PlotBase.__init__(self, parser)
 
         self.set_size(0, 0)
+        self._out = None
 
     def set_size(self, width, height):
         self.width = width
         self.height = height
 
-    def create_image(self):
-        self.svg_data = '<?xml version="1.0" standalone="no"?>\n'
-        self.svg_data += '<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" ' \
-            '"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n'
-        self.svg_data += '<svg width="%d" height="%d" version="1.1" ' \
-            ' xmlns="http://www.w3.org/2000/svg">\n' % (
-                self.width, self.height)
+    def create_image(self, out=None):
+        """
+        Start a new image. The SVG fragments are written to the file-like
+        object <out>, or collected in memory if it is None.
+        """
+        if out is None:
+            out = StringIO()
+        self._out = out
+        write = out.write
+        write('<?xml version="1.0" standalone="no"?>\n')
+        write('<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" '
+              '"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+        write('<svg width="%d" height="%d" version="1.1" '
+              ' xmlns="http://www.w3.org/2000/svg">\n' % (
+                  self.width, self.height))
 
     def finish_image(self):
-        self.svg_data += '</svg>'
+        self._out.write('</svg>')
+        if isinstance(self._out, StringIO):
+            self.svg_data = self._out.getvalue()
+        self._out = None
 
     def plot_line(self, c0, c1, col):
         c0 = self.rcoords_to_coords(c0)
         c1 = self.rcoords_to_coords(c1)
-        self.svg_data += '<line style="stroke:%s;stroke-width:1" ' \
-            'x1="%f" y1="%f" x2="%f" y2="%f" />\n' % (
-                col, c0[0], c0[1], c1[0], c1[1])
+        self._out.write('<line style="stroke:%s;stroke-width:1" '
+                        'x1="%f" y1="%f" x2="%f" y2="%f" />\n' % (
+                            col, c0[0], c0[1], c1[0], c1[1]))
 
     def plot_polyline(self, coords, col):
-        self.svg_data += '<polyline style="fill:none;stroke:%s;' \
-            'stroke-width:1" points="' % (col)
-        for c in coords:
-            c = self.rcoords_to_coords(c)
-            self.svg_data += '%f,%f ' % (c[0], c[1])
-        self.svg_data += '" />\n'
+        w = self.width
+        h = self.height
+        points = ' '.join(['%f,%f' % (x * w, y * h) for (x, y) in coords])
+        self._out.write('<polyline style="fill:none;stroke:%s;'
+                        'stroke-width:1" points="%s" />\n' % (col, points))
 
     def add_text(self, c, text, rotate=0):
-        if isinstance(text, str):
-            text = text.encode('utf-8')
+        # Imported here, it pulls in urllib and slows down the start-up
+        from xml.sax.saxutils import escape
+
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
         c = self.rcoords_to_coords(c)
 
-        self.svg_data += '<text x="%f" y="%f"' % (c[0], c[1])
         if rotate != 0:
-            self.svg_data += ' transform="rotate(%d)"' % (rotate)
-
-        self.svg_data += '>%s</text>\n' % (text)
+            transform = ' transform="rotate(%d)"' % (rotate)
+        else:
+            transform = ''
+        self._out.write('<text x="%f" y="%f"%s>%s</text>\n' % (
+            c[0], c[1], transform, escape(text)))
 
     def determine_bounds(self, vals):
         self.minx = self.miny = 1e99
         self.maxx = self.maxy = -1e99
         for (x, y) in vals:
             self.minx = min(float(x), self.minx)
-            self.miny = min(float(y), self.miny)
             self.maxx = max(float(x), self.maxx)
+            self.miny = min(float(y), self.miny)
             self.maxy = max(float(y), self.maxy)
 
         if self.minx == self.maxx:
@@ -194,15 +594,17 @@ class CustomPlot(_PlotBase):
                0.9 - (pair[1] - self.miny) / (self.maxy - self.miny) * 0.8)
         return ret
 
-    def add_curve(self, vals):
-        self.determine_bounds(vals)
-
+    def add_curve(self, vals, col="blue"):
+        # Draw a separate polyline for each part between breaks (NaN)
         c = []
         for v in vals:
-            c.append(self.vals_to_rcoords(v))
-#        print 'coords: %r' % c
-
-        self.plot_polyline(c, "blue")
+            if v[0] == v[0] and v[1] == v[1]:
+                c.append(self.vals_to_rcoords(v))
+            elif len(c) > 0:
+                self.plot_polyline(c, col)
+                c = []
+        if len(c) > 0:
+            self.plot_polyline(c, col)
 
     """
     def get_label_vals(self, startx, endx, n, opts=()):
@@ -217,6 +619,14 @@ class CustomPlot(_PlotBase):
         F = 0.8
         NOL = 4  # maximum no of labels
 
+        if len(val) == 0:
+            # Nothing could be evaluated, draw the axes without values
+            self.plot_line((0.11, 0.89), (0.92, 0.89), "black")
+            self.plot_line((0.11, 0.08), (0.11, 0.89), "black")
+            self.add_text((0.50, 0.98), labelx)
+            self.add_text((-0.50, 0.045), labely, rotate=-90)
+            return
+
         y_coords = sorted([i[1] for i in val])
         x_coords = sorted([i[0] for i in val])
 
@@ -227,7 +637,7 @@ class CustomPlot(_PlotBase):
         min_x = min(x_coords)
 
         # X axis
-        interval = len(val) / (NOL - 1)
+        interval = max(len(val) // (NOL - 1), 1)
         self.plot_line((0.11, 0.89), (0.92, 0.89), "black")
         if max_x != min_x:
             self.add_text((0.11 + min_x + F * 0, 0.93), format_float(min_x))
@@ -261,55 +671,127 @@ class CustomPlot(_PlotBase):
 
         self.add_text((-0.50, 0.045), labely, rotate=-90)
 
-    def produce_plot(self, vals, *args, **kwargs):
-        """Produce an svg plot."""
+    def produce_plot(self, curves, *args, **kwargs):
+        """
+        Produce an svg plot. If kwargs contains 'out', the image is
+        streamed to that file-like object instead of being returned.
+        """
+
+        out = kwargs.pop('out', None)
 
         self.set_size(250, 250)
-        self.create_image()
+        self.create_image(out)
 
+        # All curves share the axes
+        vals = [v for c in curves for v in c if v[0] == v[0] and v[1] == v[1]]
+        self.determine_bounds(vals)
         self.draw_axes(
             kwargs.get('xlabel', ''), kwargs.get('ylabel', ''), vals)
 
-        self.add_curve(vals)
+        for i, c in enumerate(curves):
+            self.add_curve(c, self.COLORS[i % len(self.COLORS)])
 
         self.finish_image()
 
+        if out is not None:
+            return None
         return self.svg_data
 
+    def export_plot(self, fn):
+        """Write the last plot to file <fn>, without building it in memory."""
+
+        if self._last_plot is None:
+            _PlotBase.export_plot(self, fn)
+            return
+
+        curves, kwargs = self._last_plot
+        with open(fn, 'w') as f:
+            self.produce_plot(curves, out=f, **kwargs)
+
 
 class MPLPlot(_PlotBase):
 
+    """
+    Plot using matplotlib. A single figure is kept and cleared for every
+    plot, so that memory use does not grow with the number of plots.
+    """
+
     def __init__(self, parser):
         _PlotBase.__init__(self, parser)
 
-    def produce_plot(self, vals, **kwargs):
-        x = [c[0] for c in vals]
-        y = [c[1] for c in vals]
+        # Use the object-oriented API: pylab would keep every figure
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_svg import FigureCanvasSVG
+
+        self._figure = Figure(figsize=(5, 5))
+        FigureCanvasSVG(self._figure)
+        self._axes = self._figure.add_subplot(111)
 
-        fig = pylab.figure()
-        fig.set_size_inches(5, 5)
-        ax = fig.add_subplot(111)
+    def produce_plot(self, curves, **kwargs):
+        ax = self._axes
+        ax.clear()
 
-        ax.plot(x, y, 'r-')
+        # A single curve is drawn in red, several use the color cycle
+        fmt = 'r-' if len(curves) == 1 else '-'
+        for vals in curves:
+            x = [c[0] for c in vals]
+            y = [c[1] for c in vals]
+            ax.plot(x, y, fmt)
 
         ax.set_xlabel(kwargs.get('xlabel', ''))
         ax.set_ylabel(kwargs.get('ylabel', ''))
 
-        data = StringIO()
-        fig.savefig(data)
+        data = BytesIO()
+        self._figure.savefig(data, format='svg')
         return data.getvalue()
 
 
-if USE_MPL:
-    try:
-        import matplotlib as mpl
-        mpl.use('svg')
-        from matplotlib import pylab
-        Plot = MPLPlot
-        _logger.debug('Using matplotlib as plotting back-end')
-    except ImportError:
-        USE_MPL = False
+class Plot(_PlotBase):
+
+    """
+    Plot using the back-end selected by BACKEND or set_backend(). The
+    back-end is loaded on the first plot, so that starting up does not have
+    to wait for matplotlib to be imported.
+    """
+
+    def __init__(self, parser, backend=None):
+        _PlotBase.__init__(self, parser)
+        self._backend = None
+        self.set_backend(backend or BACKEND)
+
+    def set_backend(self, name):
+        """Select back-end <name>, one of BACKENDS."""
+        if name not in BACKENDS:
+            raise ValueError('Unknown plotting back-end %r' % name)
+        self._backend_name = name
+        self._backend = None
+
+    def get_backend(self):
+        """Return the back-end, loading it if necessary."""
+        if self._backend is not None:
+            return self._backend
+
+        start = time.time()
+        if self._backend_name in ('auto', 'matplotlib'):
+            try:
+                self._backend = MPLPlot(self.parser)
+            except ImportError as e:
+                if self._backend_name == 'matplotlib':
+                    _logger.error('Unable to load matplotlib: %s', e)
+        if self._backend is None:
+            self._backend = CustomPlot(self.parser)
+        _logger.debug('Loading plotting back-end %s took %.3f s',
+                      type(self._backend).__name__, time.time() - start)
+        return self._backend
+
+    def get_backend_name(self):
+        return self.get_backend().get_backend_name()
+
+    def produce_plot(self, curves, *args, **kwargs):
+        return self.get_backend().produce_plot(curves, *args, **kwargs)
 
-if not USE_MPL:
-    Plot = CustomPlot
-    _logger.debug('Using custom plotting back-end')
+    def export_plot(self, fn):
+        backend = self.get_backend()
+        backend.set_svg(self.get_svg())
+        backend._last_plot = self._last_plot
+        backend.export_plot(fn)
@@ -0,0 +1,512 @@
+# solver.py, numeric solving, minimisation and integration in Calculate
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import sys
+import time
+from decimal import Decimal
+import logging
+_logger = logging.getLogger('Solver')
+
+from gettext import gettext as _
+
+SOLVEHELP = _(
+    "solve(eqn, var=a..b), find a value of the variable 'var' between a and \
+b for which the equation 'eqn' is zero. With more digits shown than floats \
+hold, the value is refined to all digits")
+
+MINIMIZEHELP = _(
+    "minimize(eqn, var=a..b), find the value of the variable 'var' between a \
+and b for which the equation 'eqn' is smallest, to about 8 digits")
+
+INTEGRATEHELP = _(
+    "integrate(eqn, var=a..b), calculate the integral of the equation 'eqn' \
+over the variable 'var' from a to b, to about 10 digits. If the estimated \
+error is larger, an error with the estimate is shown")
+
+_EPS = sys.float_info.epsilon
+
+# Gauss-Kronrod 7-15 rule on [-1, 1]: the Kronrod nodes and weights, the
+# Gauss nodes are every second Kronrod node, starting at index 1.
+_XGK = (
+    0.991455371120812639206854697526329,
+    0.949107912342758524526189684047851,
+    0.864864423359769072789712788640926,
+    0.741531185599394439863864773280788,
+    0.586087235467691130294144845693013,
+    0.405845151377397166906606412076961,
+    0.207784955007898467600689403773245,
+    0.0,
+)
+_WGK = (
+    0.022935322010529224963732008058970,
+    0.063092092629978553290700663189204,
+    0.104790010322250183839876322541518,
+    0.140653259715525918745189590510238,
+    0.169004726639267902826583426598550,
+    0.190350578064785409913256402421014,
+    0.204432940075298892414161999234649,
+    0.209482141084727828012999174891714,
+)
+_WG = (
+    0.129484966168869693270611432679082,
+    0.279705391489276667901467771423780,
+    0.381830050505118944950369775488975,
+    0.417959183673469387755102040816327,
+)
+
+# The 15 nodes, with the Kronrod and Gauss weight for each of them
+_GK_NODES = [-x for x in _XGK[:-1]] + list(reversed(_XGK))
+_GK_KWEIGHTS = list(_WGK[:-1]) + list(reversed(_WGK))
+_GK_GWEIGHTS = [_WG[i // 2] if i % 2 == 1 else 0.0 for i in range(7)]
+_GK_GWEIGHTS = _GK_GWEIGHTS + [_WG[3]] + list(reversed(_GK_GWEIGHTS))
+
+
+class Solver:
+
+    '''
+    Numeric functions working on an equation of one variable, such as
+    solve(), minimize() and integrate(). The equation is passed as a parse
+    tree, which is compiled once and evaluated for every step of the
+    iteration.
+
+    After each call, <iterations> and <elapsed> hold the number of
+    evaluations of the equation and the time used; after integrate(),
+    <error> holds the estimated absolute error of the result. These are
+    only written to the log; integrate() raises an error showing the
+    estimate if it is larger than the tolerance.
+
+    In precision mode the results are Decimals. solve() refines its root
+    to all digits, minimize() and integrate() are only as accurate as
+    with floats.
+    '''
+
+    MAX_ITER = 200
+
+    # Number of points to look at before iterating
+    SCAN_POINTS = 64
+
+    # Integration tolerance (relative and absolute) and the maximum number
+    # of sub-intervals to split the range into
+    INTEGRATE_TOL = 1e-10
+    MAX_INTERVALS = 1000
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.iterations = 0
+        self.elapsed = 0.0
+        self.error = 0.0
+
+    def _get_range(self, name, kwargs):
+        if len(kwargs) != 1:
+            raise ValueError(_('%s needs one variable with a range, e.g. '
+                               'x=0..1') % name)
+        var, range = list(kwargs.items())[0]
+        try:
+            a, b = float(range[0]), float(range[1])
+        except (TypeError, ValueError, IndexError):
+            raise ValueError(_('%s needs one variable with a range, e.g. '
+                               'x=0..1') % name)
+        return var, a, b
+
+    def _make_func(self, tree, var):
+        '''Return a function evaluating <tree> as a function of <var>.'''
+
+        if type(tree) in (bytes, str):
+            tree = self.parser.parse(tree)
+
+        def f(x):
+            self.iterations += 1
+            self.parser.set_var(var, x)
+            return float(self.parser.evaluate(tree))
+
+        return tree, f
+
+    def _scan(self, f, a, b):
+        '''Return a list of (x, f(x)) on a grid, skipping failures.'''
+
+        from astparser import LimitError
+
+        n = self.SCAN_POINTS
+        ret = []
+        for i in range(n + 1):
+            x = a + (b - a) * i / n
+            try:
+                y = f(x)
+            except LimitError:
+                raise
+            except Exception as e:
+                _logger.debug('Can not evaluate at %r: %s', x, e)
+                continue
+            if y == y:
+                ret.append((x, y))
+        return ret
+
+    def _run(self, name, func, eqn, kwargs):
+        var, a, b = self._get_range(name, kwargs)
+        old_value = self.parser.get_var(var)
+        self.iterations = 0
+        start = time.time()
+        try:
+            tree, f = self._make_func(eqn, var)
+            ret = func(tree, f, var, a, b)
+            if self.parser.precision is not None and \
+                    not isinstance(ret, Decimal):
+                ret = self.parser.ml.d(ret)
+        finally:
+            self.parser.set_var(var, old_value)
+            self.elapsed = time.time() - start
+        _logger.info('%s(): %r after %d evaluations in %.3f s', name, ret,
+                     self.iterations, self.elapsed)
+        return ret
+
+    def solve(self, eqn, **kwargs):
+        '''
+        Find a root of <eqn> in the range given for its variable, e.g.
+        solve(x^2 - 2, x=0..2). Uses Brent's method on a range where the
+        sign of <eqn> changes, otherwise Newton's method.
+        '''
+        return self._run('solve', self._solve, eqn, kwargs)
+
+    def _solve(self, tree, f, var, a, b):
+        a, b = min(a, b), max(a, b)
+        x = self._solve_float(tree, f, var, a, b)
+        if self.parser.precision is not None:
+            return self._refine_root(tree, var, x, a, b)
+        return x
+
+    def _solve_float(self, tree, f, var, a, b):
+        points = self._scan(f, a, b)
+        if len(points) == 0:
+            raise ValueError(_('Can not evaluate the equation in this range'))
+
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if y0 == 0:
+                return x0
+            if y0 * y1 < 0:
+                return self._brent_root(f, x0, x1, y0, y1)
+        if points[-1][1] == 0:
+            return points[-1][0]
+
+        # No sign change, e.g. a double root: try Newton's method from the
+        # point closest to zero
+        x, y = min(points, key=lambda p: abs(p[1]))
+        ret = self._newton(tree, f, var, x, y, a, b)
+        if ret is None:
+            raise ValueError(_('No solution found in this range'))
+        return ret
+
+    def _refine_root(self, tree, var, x, a, b):
+        '''
+        Refine the root <x> found with floats to the digits of precision
+        mode with the secant method, evaluating <tree> with Decimals.
+        Returns the best approximation found as a Decimal.
+        '''
+
+        from astparser import LimitError
+
+        d = self.parser.ml.d
+
+        def f(x):
+            self.iterations += 1
+            self.parser.set_var(var, x)
+            return d(self.parser.evaluate(tree))
+
+        x1 = best = d(x)
+        try:
+            y1 = f(x1)
+            best_y = abs(y1)
+            x0 = x1 + max(abs(x1), 1) * Decimal('1e-10')
+            y0 = f(x0)
+            for i in range(self.MAX_ITER):
+                if y1 == 0 or y1 == y0:
+                    break
+                step = y1 * (x1 - x0) / (y1 - y0)
+                x0, y0 = x1, y1
+                x1 = x1 - step
+                if not a <= x1 <= b:
+                    break
+                y1 = f(x1)
+                if abs(y1) < best_y:
+                    best, best_y = x1, abs(y1)
+                if abs(step) <= abs(x1).scaleb(-self.parser.precision):
+                    break
+        except LimitError:
+            raise
+        except Exception as e:
+            _logger.debug('Can not refine the root: %s', e)
+        return best
+
+    def _brent_root(self, f, a, b, fa, fb):
+        '''Brent's method for a root between a and b, f(a) * f(b) < 0.'''
+
+        c, fc = a, fa
+        d = e = b - a
+        for i in range(self.MAX_ITER):
+            if fb * fc > 0:
+                c, fc = a, fa
+                d = e = b - a
+            if abs(fc) < abs(fb):
+                a, b, c = b, c, b
+                fa, fb, fc = fb, fc, fb
+
+            tol = 2 * _EPS * abs(b)
+            xm = 0.5 * (c - b)
+            if abs(xm) <= tol or fb == 0:
+                return b
+
+            if abs(e) >= tol and abs(fa) > abs(fb):
+                # Inverse quadratic interpolation or secant
+                s = fb / fa
+                if a == c:
+                    p = 2 * xm * s
+                    q = 1 - s
+                else:
+                    q = fa / fc
+                    r = fb / fc
+                    p = s * (2 * xm * q * (q - r) - (b - a) * (r - 1))
+                    q = (q - 1) * (r - 1) * (s - 1)
+                if p > 0:
+                    q = -q
+                p = abs(p)
+                if 2 * p < min(3 * xm * q - abs(tol * q), abs(e * q)):
+                    e = d
+                    d = p / q
+                else:
+                    d = e = xm
+            else:
+                # Bisection
+                d = e = xm
+
+            a, fa = b, fb
+            if abs(d) > tol:
+                b += d
+            else:
+                b += tol if xm > 0 else -tol
+            fb = f(b)
+
+        return b
+
+    def _newton(self, tree, f, var, x, y, a, b):
+        '''
+        Newton's method from x, using the symbolic derivative of <tree>.
+        Returns None if it does not converge within [a, b].
+        '''
+
+        try:
+            dtree = self.parser.differentiate(tree, var)
+        except ValueError as e:
+            _logger.debug('No derivative for Newton: %s', e)
+            return None
+
+        for i in range(self.MAX_ITER):
+            self.iterations += 1
+            dy = float(self.parser.evaluate(dtree))
+            if dy == 0:
+                return x if y == 0 else None
+            step = y / dy
+            x -= step
+            if not a <= x <= b:
+                return None
+            y = f(x)
+            if y == 0 or abs(step) <= 4 * _EPS * max(abs(x), 1e-300):
+                return x
+        return None
+
+    def minimize(self, eqn, **kwargs):
+        '''
+        Find where <eqn> is smallest in the range given for its variable,
+        e.g. minimize(x^2 - 2*x, x=-5..5). Uses Brent's method around the
+        smallest of a number of sampled points.
+        '''
+        return self._run('minimize', self._minimize, eqn, kwargs)
+
+    def _minimize(self, tree, f, var, a, b):
+        a, b = min(a, b), max(a, b)
+        points = self._scan(f, a, b)
+        if len(points) == 0:
+            raise ValueError(_('Can not evaluate the equation in this range'))
+
+        i = min(range(len(points)), key=lambda i: points[i][1])
+        x, y = points[i]
+        lo = points[max(i - 1, 0)][0]
+        hi = points[min(i + 1, len(points) - 1)][0]
+        if lo == hi:
+            return x
+        return self._brent_min(f, lo, hi, x, y)
+
+    def _brent_min(self, f, a, b, x, fx):
+        '''Brent's method for a minimum between a and b, starting at x.'''
+
+        cgold = 0.3819660
+        tol = _EPS ** 0.5
+        v = w = x
+        fv = fw = fx
+        d = e = 0.0
+        for i in range(self.MAX_ITER):
+            xm = 0.5 * (a + b)
+            tol1 = tol * abs(x) + 1e-12
+            tol2 = 2 * tol1
+            if abs(x - xm) <= tol2 - 0.5 * (b - a):
+                return x
+
+            if abs(e) > tol1:
+                # Parabolic fit
+                r = (x - w) * (fx - fv)
+                q = (x - v) * (fx - fw)
+                p = (x - v) * q - (x - w) * r
+                q = 2 * (q - r)
+                if q > 0:
+                    p = -p
+                q = abs(q)
+                etemp = e
+                e = d
+                if abs(p) >= abs(0.5 * q * etemp) or p <= q * (a - x) or \
+                        p >= q * (b - x):
+                    e = a - x if x >= xm else b - x
+                    d = cgold * e
+                else:
+                    d = p / q
+                    u = x + d
+                    if u - a < tol2 or b - u < tol2:
+                        d = tol1 if xm >= x else -tol1
+            else:
+                # Golden section
+                e = a - x if x >= xm else b - x
+                d = cgold * e
+
+            if abs(d) >= tol1:
+                u = x + d
+            else:
+                u = x + (tol1 if d >= 0 else -tol1)
+            fu = f(u)
+
+            if fu <= fx:
+                if u >= x:
+                    a = x
+                else:
+                    b = x
+                v, w, x = w, x, u
+                fv, fw, fx = fw, fx, fu
+            else:
+                if u < x:
+                    a = u
+                else:
+                    b = u
+                if fu <= fw or w == x:
+                    v, w = w, u
+                    fv, fw = fw, fu
+                elif fu <= fv or v == x or v == w:
+                    v = u
+                    fv = fu
+
+        return x
+
+    def integrate(self, eqn, **kwargs):
+        '''
+        Calculate the integral of <eqn> over the range given for its
+        variable, e.g. integrate(sin(x), x=0..pi). Uses adaptive
+        Gauss-Kronrod quadrature, the estimated error is kept in <error>.
+        '''
+        self.error = 0.0
+        try:
+            return self._run('integrate', self._integrate, eqn, kwargs)
+        finally:
+            # Also when it does not converge
+            _logger.info('integrate(): estimated error %g', self.error)
+
+    def _integrate(self, tree, f, var, a, b):
+        if a == b:
+            return 0.0
+
+        # Each interval is (lo, hi, integral, error estimate). Every round,
+        # all intervals with too large an error are split in two, and the
+        # points of all new halves are evaluated in one go.
+        intervals = self._gauss_kronrod(tree, f, var, [(a, b)])
+        while True:
+            total = sum(i[2] for i in intervals)
+            error = sum(i[3] for i in intervals)
+            tol = max(self.INTEGRATE_TOL * abs(total), self.INTEGRATE_TOL)
+            if error <= tol or len(intervals) >= self.MAX_INTERVALS:
+                break
+
+            keep, split = [], []
+            for lo, hi, val, err in intervals:
+                mid = 0.5 * (lo + hi)
+                if err <= tol * abs((hi - lo) / (b - a)) or \
+                        not min(lo, hi) < mid < max(lo, hi):
+                    keep.append((lo, hi, val, err))
+                else:
+                    split.extend(((lo, mid), (mid, hi)))
+            if len(split) == 0:
+                break
+            intervals = keep + self._gauss_kronrod(tree, f, var, split)
+
+        self.error = error
+        if error > tol:
+            raise ValueError(_('The integral does not converge, the '
+                               'estimated error is %g') % error)
+        return total
+
+    def _gauss_kronrod(self, tree, f, var, ranges):
+        '''
+        Apply the Gauss-Kronrod rule to each (lo, hi) in <ranges>, return
+        a list of (lo, hi, integral, error estimate).
+        '''
+
+        xs = []
+        for lo, hi in ranges:
+            c = 0.5 * (lo + hi)
+            h = 0.5 * (hi - lo)
+            xs.extend(c + h * x for x in _GK_NODES)
+        ys = self._evaluate_points(tree, f, var, xs)
+
+        n = len(_GK_NODES)
+        ret = []
+        for i, (lo, hi) in enumerate(ranges):
+            vals = ys[i * n:(i + 1) * n]
+            h = 0.5 * (hi - lo)
+            k = h * sum(w * y for w, y in zip(_GK_KWEIGHTS, vals))
+            g = h * sum(w * y for w, y in zip(_GK_GWEIGHTS, vals))
+            ret.append((lo, hi, k, abs(k - g)))
+        return ret
+
+    def _evaluate_points(self, tree, f, var, xs):
+        '''
+        Evaluate <tree> at all points in <xs>, at once with <var> bound to
+        a NumPy array if possible.
+        '''
+
+        ys = None
+        np = self.parser.get_numpy()
+        if np is not None:
+            x = np.array(xs, dtype=float)
+            self.parser.set_var(var, x)
+            try:
+                ret = self.parser.evaluate(tree, vector=True)
+                if ret is not None:
+                    ys = np.broadcast_to(np.asarray(ret, dtype=float),
+                                         x.shape).tolist()
+                    self.iterations += len(xs)
+            except Exception as e:
+                _logger.debug('Falling back to scalar evaluation: %s', e)
+        if ys is None:
+            ys = [f(x) for x in xs]
+
+        for y in ys:
+            if y != y or abs(y) == float('inf'):
+                raise ValueError(_('Can not integrate the equation in this '
+                                   'range'))
+        return ys
@@ -0,0 +1,391 @@
+# symbolic.py, symbolic manipulation of parse trees in Calculate
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ast
+
+from gettext import gettext as _
+
+
+def _const(value):
+    return ast.Constant(value=value)
+
+
+def _value(node):
+    '''Return the value of a constant node, or None.'''
+    if isinstance(node, ast.Num):
+        return node.n
+    elif isinstance(node, ast.Constant):
+        return node.value
+    return None
+
+
+def _is_number(node):
+    v = _value(node)
+    return v is not None and not isinstance(v, (bool, str))
+
+
+def _is_value(node, value):
+    return _is_number(node) and _value(node) == value
+
+
+def _is_negative(node):
+    return _is_number(node) and _value(node) < 0
+
+
+def _name(name):
+    return ast.Name(id=name, ctx=ast.Load())
+
+
+def _call(name, *args):
+    return ast.Call(func=_name(name), args=list(args), keywords=[])
+
+
+def _neg(a):
+    if isinstance(a, ast.UnaryOp) and isinstance(a.op, ast.USub):
+        return a.operand
+    if _is_number(a):
+        return _const(-_value(a))
+    return ast.UnaryOp(op=ast.USub(), operand=a)
+
+
+def _add(a, b):
+    if _is_value(a, 0):
+        return b
+    if _is_value(b, 0):
+        return a
+    if _is_negative(b) or \
+            (isinstance(b, ast.UnaryOp) and isinstance(b.op, ast.USub)):
+        return ast.BinOp(left=a, op=ast.Sub(), right=_neg(b))
+    return ast.BinOp(left=a, op=ast.Add(), right=b)
+
+
+def _sub(a, b):
+    if _is_value(b, 0):
+        return a
+    if _is_value(a, 0):
+        return _neg(b)
+    if _is_negative(b) or \
+            (isinstance(b, ast.UnaryOp) and isinstance(b.op, ast.USub)):
+        return ast.BinOp(left=a, op=ast.Add(), right=_neg(b))
+    return ast.BinOp(left=a, op=ast.Sub(), right=b)
+
+
+def _mul(a, b):
+    if _is_value(a, 0) or _is_value(b, 0):
+        return _const(0)
+    if _is_value(a, 1):
+        return b
+    if _is_value(b, 1):
+        return a
+    if _is_value(a, -1):
+        return _neg(b)
+    if _is_value(b, -1):
+        return _neg(a)
+    return ast.BinOp(left=a, op=ast.Mult(), right=b)
+
+
+def _div(a, b):
+    if _is_value(a, 0):
+        return _const(0)
+    if _is_value(b, 1):
+        return a
+    return ast.BinOp(left=a, op=ast.Div(), right=b)
+
+
+def _pow(a, b):
+    if _is_value(b, 0):
+        return _const(1)
+    if _is_value(b, 1):
+        return a
+    return ast.BinOp(left=a, op=ast.Pow(), right=b)
+
+
+# Builders that simplify while combining nodes
+_BUILDERS = {
+    ast.Add: _add,
+    ast.Sub: _sub,
+    ast.Mult: _mul,
+    ast.Div: _div,
+    ast.Pow: _pow,
+}
+
+
+def simplify(node):
+    '''
+    Return a copy of <node> without trivial operations such as 0 + x,
+    1 * x and x ^ 1. <node> is not modified.
+    '''
+
+    if isinstance(node, ast.Expression):
+        return ast.Expression(body=simplify(node.body))
+    elif isinstance(node, ast.Expr):
+        return ast.Expr(value=simplify(node.value))
+    elif isinstance(node, ast.BinOp):
+        left = simplify(node.left)
+        right = simplify(node.right)
+        builder = _BUILDERS.get(type(node.op))
+        if builder is not None:
+            return builder(left, right)
+        return ast.BinOp(left=left, op=node.op, right=right)
+    elif isinstance(node, ast.UnaryOp):
+        operand = simplify(node.operand)
+        if isinstance(node.op, ast.USub):
+            return _neg(operand)
+        return ast.UnaryOp(op=node.op, operand=operand)
+    elif isinstance(node, ast.Call):
+        return ast.Call(func=node.func,
+                        args=[simplify(arg) for arg in node.args],
+                        keywords=node.keywords)
+    return node
+
+
+# Derivatives of functions of one argument, in terms of that argument u.
+# Trigonometric functions take angle scaling s into account.
+_DERIVATIVES = {
+    'abs': lambda u, s: _div(u, _call('abs', u)),
+    'acos': lambda u, s: _neg(_div(_const(1), _mul(_call(
+        'sqrt', _sub(_const(1), _pow(u, _const(2)))), s))),
+    'acosh': lambda u, s: _div(_const(1), _call(
+        'sqrt', _sub(_pow(u, _const(2)), _const(1)))),
+    'asin': lambda u, s: _div(_const(1), _mul(_call(
+        'sqrt', _sub(_const(1), _pow(u, _const(2)))), s)),
+    'asinh': lambda u, s: _div(_const(1), _call(
+        'sqrt', _add(_pow(u, _const(2)), _const(1)))),
+    'atan': lambda u, s: _div(_const(1), _mul(
+        _add(_const(1), _pow(u, _const(2))), s)),
+    'atanh': lambda u, s: _div(_const(1), _sub(
+        _const(1), _pow(u, _const(2)))),
+    'ceil': lambda u, s: _const(0),
+    'cos': lambda u, s: _neg(_mul(s, _call('sin', u))),
+    'cosh': lambda u, s: _call('sinh', u),
+    'exp': lambda u, s: _call('exp', u),
+    'floor': lambda u, s: _const(0),
+    'inv': lambda u, s: _neg(_div(_const(1), _pow(u, _const(2)))),
+    'ln': lambda u, s: _div(_const(1), u),
+    'log10': lambda u, s: _div(_const(1), _mul(u, _call('ln', _const(10)))),
+    'negate': lambda u, s: _const(-1),
+    'round': lambda u, s: _const(0),
+    'sin': lambda u, s: _mul(s, _call('cos', u)),
+    'sinc': lambda u, s: _div(_sub(_mul(_mul(s, _call('cos', u)), u),
+                                   _call('sin', u)), _pow(u, _const(2))),
+    'sinh': lambda u, s: _call('cosh', u),
+    'sqrt': lambda u, s: _div(_const(1), _mul(_const(2), _call('sqrt', u))),
+    'square': lambda u, s: _mul(_const(2), u),
+    'tan': lambda u, s: _div(s, _pow(_call('cos', u), _const(2))),
+    'tanh': lambda u, s: _sub(_const(1), _pow(_call('tanh', u), _const(2))),
+}
+
+# Functions of two arguments that correspond to an operator
+_BINOP_FUNCS = {
+    'add': ast.Add,
+    'sub': ast.Sub,
+    'mul': ast.Mult,
+    'div': ast.Div,
+    'pow': ast.Pow,
+}
+
+
+class Differentiator:
+
+    '''
+    Differentiate parse trees symbolically. Labelled equations used in the
+    tree are differentiated too. The result is simplified by the constant
+    folding of the parser.
+    '''
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def differentiate(self, tree, var):
+        '''
+        Return the derivative of <tree> with respect to variable <var> as
+        a new ast.Expression tree.
+        '''
+
+        if isinstance(tree, ast.Expression):
+            tree = tree.body
+        elif isinstance(tree, ast.Expr):
+            tree = tree.value
+
+        scaling = self.parser.get_var('angle_scaling')
+        self._scaling = _const(getattr(scaling, 'value', 1.0))
+        if _is_value(self._scaling, 1.0):
+            self._scaling = _const(1)
+
+        ret = ast.Expression(body=self._diff(tree, var, []))
+        ret = ast.fix_missing_locations(ret)
+        ret = simplify(self.parser.fold_constants(ret))
+        return ast.fix_missing_locations(ret)
+
+    def _depends_on(self, node, var):
+        return var in self.parser.get_tree_vars(node)
+
+    def _diff(self, node, var, stack):
+        if isinstance(node, ast.Expr):
+            return self._diff(node.value, var, stack)
+
+        elif _value(node) is not None:
+            return _const(0)
+
+        elif isinstance(node, ast.Name):
+            if node.id == var:
+                return _const(1)
+            value = self.parser.get_var(node.id)
+            if type(value) in (ast.Expression, ast.Expr):
+                if node.id in stack:
+                    raise ValueError(_('Recursion detected'))
+                return self._diff(value, var, stack + [node.id])
+            return _const(0)
+
+        elif isinstance(node, ast.UnaryOp):
+            du = self._diff(node.operand, var, stack)
+            if isinstance(node.op, ast.USub):
+                return _neg(du)
+            elif isinstance(node.op, ast.UAdd):
+                return du
+
+        elif isinstance(node, ast.BinOp):
+            return self._diff_binop(node.op, node.left, node.right, var,
+                                    stack)
+
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            return self._diff_call(node, var, stack)
+
+        if not self._depends_on(node, var):
+            return _const(0)
+        raise ValueError(_('Can not differentiate this expression'))
+
+    def _diff_binop(self, op, u, v, var, stack):
+        du = self._diff(u, var, stack)
+        dv = self._diff(v, var, stack)
+
+        if isinstance(op, ast.Add):
+            return _add(du, dv)
+
+        elif isinstance(op, ast.Sub):
+            return _sub(du, dv)
+
+        elif isinstance(op, ast.Mult):
+            return _add(_mul(du, v), _mul(u, dv))
+
+        elif isinstance(op, ast.Div):
+            if _is_value(dv, 0):
+                return _div(du, v)
+            return _div(_sub(_mul(du, v), _mul(u, dv)), _pow(v, _const(2)))
+
+        elif isinstance(op, ast.Pow):
+            if _is_value(dv, 0):
+                # d(u^n) = n * u^(n-1) * du
+                if _is_number(v):
+                    n1 = _const(_value(v) - 1)
+                else:
+                    n1 = _sub(v, _const(1))
+                return _mul(_mul(v, _pow(u, n1)), du)
+            if _is_value(du, 0):
+                # d(a^v) = a^v * ln(a) * dv
+                return _mul(_mul(_pow(u, v), _call('ln', u)), dv)
+            # d(u^v) = u^v * (dv * ln(u) + v * du / u)
+            return _mul(_pow(u, v), _add(_mul(dv, _call('ln', u)),
+                                         _div(_mul(v, du), u)))
+
+        if _is_value(du, 0) and _is_value(dv, 0):
+            return _const(0)
+        raise ValueError(_('Can not differentiate this expression'))
+
+    def _diff_call(self, node, var, stack):
+        name = node.func.id
+        args = node.args
+
+        if name in _BINOP_FUNCS and len(args) == 2:
+            return self._diff_binop(_BINOP_FUNCS[name](), args[0], args[1],
+                                    var, stack)
+
+        if not self._depends_on(node, var):
+            return _const(0)
+
+        func = _DERIVATIVES.get(name)
+        if func is None or len(args) != 1 or len(node.keywords) > 0:
+            raise ValueError(_("Can not differentiate function '%s'") % name)
+
+        # Chain rule
+        u = args[0]
+        return _mul(func(u, self._scaling), self._diff(u, var, stack))
+
+
+# Operator precedence and symbols used to write trees as equations
+_BINOP_FORMAT = {
+    ast.Add: (1, '+'),
+    ast.Sub: (1, '-'),
+    ast.Mult: (2, '*'),
+    ast.Div: (2, '/'),
+    ast.Mod: (2, '%'),
+    ast.Pow: (4, '^'),
+}
+
+
+def tree_to_str(node, prec=0):
+    '''Write parse tree <node> as an equation that can be parsed again.'''
+
+    if isinstance(node, ast.Expression):
+        return tree_to_str(node.body)
+    elif isinstance(node, ast.Expr):
+        return tree_to_str(node.value)
+
+    value = _value(node)
+    if value is not None:
+        if isinstance(value, str):
+            return repr(value)
+        ret = str(value)
+        # Fractions bind like the / operator
+        if '/' in ret and prec > 2:
+            ret = '(%s)' % ret
+        return ret
+
+    elif isinstance(node, ast.Name):
+        return node.id
+
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in (ast.USub,
+                                                             ast.UAdd):
+        sym = '-' if isinstance(node.op, ast.USub) else '+'
+        return sym + tree_to_str(node.operand, 3)
+
+    elif isinstance(node, ast.BinOp) and type(node.op) in _BINOP_FORMAT:
+        op_prec, sym = _BINOP_FORMAT[type(node.op)]
+        # Left-associative, except for power
+        if isinstance(node.op, ast.Pow):
+            lprec, rprec = op_prec + 1, op_prec
+        else:
+            lprec, rprec = op_prec, op_prec + 1
+        left = tree_to_str(node.left, lprec)
+        right = tree_to_str(node.right, rprec)
+        # A sign binds less tightly than the operator on its left
+        if left.startswith('-') and (op_prec > 2 or prec > 1):
+            left = '(%s)' % left
+        if right.startswith('-'):
+            right = '(%s)' % right
+        ret = '%s%s%s' % (left, sym, right)
+        return '(%s)' % ret if op_prec < prec else ret
+
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        args = [tree_to_str(arg) for arg in node.args]
+        args += ['%s=%s' % (kw.arg, tree_to_str(kw.value))
+                 for kw in node.keywords]
+        return '%s(%s)' % (node.func.id, ', '.join(args))
+
+    elif isinstance(node, ast.Tuple):
+        return '(%s)' % ', '.join([tree_to_str(elt) for elt in node.elts])
+
+    raise ValueError(_('Can not write this expression'))
@@ -0,0 +1,46 @@
+import unittest
+
+from astparser import AstParser, LimitError
+
+
+class LimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = AstParser()
+
+    def test_timeout_in_function(self):
+        # factorize() stops at the deadline, the error points at its call
+        self.parser.set_limits(max_time=0.2)
+        eqn = '1+factorize(2**128+1)'
+        with self.assertRaises(LimitError) as cm:
+            self.parser.evaluate(self.parser.parse(eqn))
+        self.assertEqual(cm.exception.get_range(), (2, len(eqn)))
+
+
+class SharedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = AstParser()
+
+    def evaluate(self, eqn):
+        return self.parser.evaluate(self.parser.parse(eqn))
+
+    def test_shared(self):
+        self.parser.set_var('x', 3)
+        self.assertEqual(self.evaluate('(x*2+1, x*2+1)'), (7, 7))
+
+    def test_volatile_label(self):
+        self.parser.set_var('v', self.parser.parse('rand_float()'))
+        a, b = self.evaluate('(v*1, v*1)')
+        self.assertNotEqual(a, b)
+
+    def test_label_made_volatile(self):
+        self.parser.set_var('v', self.parser.parse('2'))
+        self.assertEqual(self.evaluate('(v*1, v*1)'), (2, 2))
+        self.parser.set_var('v', self.parser.parse('rand_float()'))
+        a, b = self.evaluate('(v*1, v*1)')
+        self.assertNotEqual(a, b)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from decimal import Decimal
+
+from mathlib import MathLib
+
+
+class FormatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ml = MathLib()
+
+    def test_int_digit_limit(self):
+        # Integers with more than INT_DIGIT_LIMIT digits get an exponent,
+        # cut off the same way for ints and Decimals
+        cases = [
+            (10 ** 99, '1' + '0' * 99),
+            (10 ** 100 - 1, '9' * 100),
+            (2 ** 333, '1.74980057×10**100'),
+            (10 ** 101 - 1, '9.99999999×10**100'),
+            (-(10 ** 101 - 1), '-9.99999999×10**100'),
+        ]
+        for n, text in cases:
+            self.assertEqual(self.ml.format_number(n), text)
+            self.assertEqual(self.ml.format_number(Decimal(n)), text)
+
+    def test_full(self):
+        n = 10 ** 101 - 1
+        self.assertEqual(self.ml.format_number(n, full=True), str(n))
+        self.assertEqual(self.ml.format_number(Decimal(n), full=True),
+                         str(n))
+
+    def test_integral_decimal(self):
+        # Zero computed with 30 digits, e.g. exp(1)-e in precision mode
+        self.assertEqual(self.ml.format_number(Decimal('0E-29')), '0')
+        self.assertEqual(self.ml.format_number(Decimal('-0.0')), '0')
+        self.assertEqual(self.ml.format_number(Decimal('1E+5')), '100000')
+        self.assertEqual(self.ml.format_number(Decimal('3.00')), '3')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from astparser import AstParser
+from plotlib import CustomPlot
+
+
+class PlotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = AstParser()
+
+    def test_zero_width_range(self):
+        vals = self.parser.pl.evaluate('x*2', 'x', (3, 3))
+        self.assertTrue(len(vals) > 0)
+        self.assertTrue(all([v == (3.0, 6.0) for v in vals]))
+
+        res = self.parser.evaluate(self.parser.parse('plot(x, x=0..0)'))
+        self.assertIn(b'</svg>', res)
+
+    def test_no_values(self):
+        plot = CustomPlot(self.parser)
+        res = plot.produce_plot([[(float('nan'), 1.0)]])
+        self.assertIn('</svg>', res)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from astparser import AstParser, ParserError
+
+
+class IntegrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = AstParser()
+
+    def evaluate(self, eqn):
+        return self.parser.evaluate(self.parser.parse(eqn))
+
+    def test_error_logged(self):
+        with self.assertLogs('Solver', 'INFO') as cm:
+            self.assertAlmostEqual(self.evaluate('integrate(x^2, x=0..3)'), 9)
+        self.assertTrue(any(['estimated error' in line
+                             for line in cm.output]))
+
+    def test_no_convergence(self):
+        with self.assertLogs('Solver', 'INFO') as cm:
+            with self.assertRaises(ParserError) as err:
+                self.evaluate('integrate(1/x, x=0..1)')
+        self.assertIn('estimated error', str(err.exception))
+        self.assertTrue(any(['estimated error' in line
+                             for line in cm.output]))
+
+
+if __name__ == '__main__':
+    unittest.main()
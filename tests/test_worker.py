@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from astparser import AstParser
+from worker import evaluate_worker
+
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),
+                     'needs fork')
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.calls_path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.calls_path)
+
+        # Count calls in a file, the worker process can not return them
+        def probe():
+            with open(self.calls_path, 'a') as f:
+                f.write('.')
+            return 7
+
+        self.parser = AstParser()
+        self.parser.set_var('probe', probe)
+
+    def get_calls(self):
+        with open(self.calls_path) as f:
+            return len(f.read())
+
+    def run_worker(self, eqn, label=''):
+        '''Evaluate <eqn> like the activity does and return the result.'''
+        tree = self.parser.parse(eqn)
+        ctx = multiprocessing.get_context('fork')
+        conn, conn2 = ctx.Pipe(duplex=False)
+        worker = ctx.Process(target=evaluate_worker,
+                             args=(self.parser, tree, None, label, conn2))
+        worker.start()
+        conn2.close()
+        (res, used_var_ofs, res2, plots, dep_values, var_values) = \
+            conn.recv()
+        worker.join()
+        if len(label) > 0:
+            self.parser.set_var(label, tree)
+        self.parser.set_var('Ans', res)
+        self.parser.update_var_values(var_values)
+        return res
+
+    def test_label_values_kept(self):
+        self.assertEqual(self.run_worker('probe()', 'a'), 7)
+        calls = self.get_calls()
+        self.assertEqual(self.run_worker('a*2', 'b'), 14)
+        self.assertEqual(self.run_worker('b+1'), 15)
+        self.assertEqual(self.get_calls(), calls)
+
+    def test_dependent_values_kept(self):
+        self.run_worker('1', 'a')
+        self.run_worker('a+probe()', 'b')
+        # The worker evaluates b with the new a
+        self.run_worker('3', 'a')
+        calls = self.get_calls()
+        self.assertEqual(self.run_worker('b+1'), 11)
+        self.assertEqual(self.get_calls(), calls)
+
+    def test_changed_values_dropped(self):
+        self.run_worker('probe()', 'a')
+        self.parser.set_var('a', self.parser.parse('2'))
+        self.assertEqual(self.run_worker('a*2'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
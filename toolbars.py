@@ -360,6 +360,7 @@ class MiscToolbar(Gtk.Toolbar):
             {'icon': 'digits-6', 'html': '6'},
             {'icon': 'digits-12', 'html': '12'},
             {'icon': 'digits-15', 'html': '15'},
+            {'icon': 'digits-30', 'html': '30'},
         ]
         self._digits_button = IconToggleToolButton(
             el,
@@ -428,6 +429,7 @@ class MiscToolbar(Gtk.Toolbar):
 
     def update_digits(self, text, calc):
         calc.ml.set_digit_limit(int(text))
+        calc.parser.set_precision(calc.ml.digit_limit)
         _logger.debug('Digit limit: %s', calc.ml.digit_limit)
 
     def update_int_base(self, text, calc):
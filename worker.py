@@ -0,0 +1,101 @@
+# worker.py, evaluation of equations in a worker process for Calculate
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# A forked worker process gets a copy of the parser, and its changes are
+# lost when it exits. The plots and the values of labelled equations it
+# computed are sent back with the result, so that the activity can keep
+# them for the next evaluation.
+
+import logging
+_logger = logging.getLogger('Worker')
+
+from gettext import gettext as _
+
+from astparser import ParserError, ParseError
+
+
+def is_svg(res):
+    '''Return whether result <res> is an SVG image, such as a plot.'''
+    if isinstance(res, bytes):
+        return res.find(b'</svg>') > -1
+    return isinstance(res, str) and res.find('</svg>') > -1
+
+
+def evaluate(parser, tree, tree2, label):
+    '''
+    Evaluate <tree> and return the result, the offsets of the variables it
+    used, the result of <tree2> (if any), the plots made, the new values
+    of the labelled equations that depend on <label>, if it is set, and
+    the values of labelled equations cached by the parser, for
+    AstParser.update_var_values().
+    '''
+
+    res2 = None
+    try:
+        res = parser.evaluate(tree)
+    except ParserError as e:
+        res = e
+    except Exception as e:
+        _logger.error('Internal error in worker (%s): %s', type(e), e)
+        res = ParseError(_('Internal error'), 0, '')
+
+    used_var_ofs = {}
+    for name in parser.get_last_used_vars():
+        used_var_ofs[name] = parser.get_var_used_ofs(name)
+
+    if tree2 is not None and not isinstance(res, ParserError) and \
+            not is_svg(res):
+        try:
+            res2 = parser.evaluate(tree2)
+        except Exception as e:
+            _logger.debug('Evaluating with LastEqn failed: %s', e)
+
+    # Labelled equations using <label> change with it, recompute them here
+    # instead of in the main loop
+    dep_values = {}
+    if len(label) > 0 and not isinstance(res, ParserError) and \
+            label not in used_var_ofs:
+        try:
+            parser.set_var(label, tree2 if res2 is not None else tree)
+        except Exception as e:
+            _logger.debug('Can not set %s: %s', label, e)
+        else:
+            parser.cache_var_value(label, res2 if res2 is not None else res)
+            for dep in parser.get_dependent_vars(label):
+                try:
+                    dep_values[dep] = parser.get_var_value(dep)
+                except Exception as e:
+                    _logger.debug('Can not evaluate %s: %s', dep, e)
+
+    plots = parser.pl.cache.pop_added()
+    var_values = parser.pop_var_values()
+    return (res, used_var_ofs, res2, plots, dep_values, var_values)
+
+
+def evaluate_worker(parser, tree, tree2, label, conn):
+    '''
+    Evaluate like evaluate() in a worker process, and send the results
+    through <conn>.
+    '''
+
+    ret = evaluate(parser, tree, tree2, label)
+    try:
+        conn.send(ret)
+    except Exception as e:
+        # Not all results can be sent to the main process
+        _logger.debug('Sending result failed: %s', e)
+        conn.send((str(ret[0]), ret[1], None, [], {}, []))
+    conn.close()